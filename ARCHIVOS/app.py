@@ -1,48 +1,162 @@
 import smtplib
+import copy
+import functools
+import threading
+import time
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
+
+
+@dataclass(frozen=True)
+class _ErrorEmailCfg:
+    """Configuración del email de alertas, leída una sola vez por proceso."""
+    enabled: bool
+    to: str | None
+    sender: str | None
+    host: str | None
+    port: int
+    user: str | None
+    password: str | None
+
+    @property
+    def is_complete(self):
+        return all([self.to, self.sender, self.host, self.user, self.password])
+
+
+@functools.lru_cache(maxsize=1)
+def _error_email_cfg():
+    """Lee y convierte las variables ERROR_EMAIL_* una única vez."""
+    return _ErrorEmailCfg(
+        enabled=_env('ERROR_EMAIL_ENABLED', 'False').lower() == 'true',
+        to=_env('ERROR_EMAIL_TO'),
+        sender=_env('ERROR_EMAIL_FROM'),
+        host=_env('ERROR_EMAIL_HOST'),
+        port=int(_env('ERROR_EMAIL_PORT', 587)),
+        user=_env('ERROR_EMAIL_USER'),
+        password=_env('ERROR_EMAIL_PASS'),
+    )
+
+
+class _SMTPPool:
+    """
+    Mantiene una única conexión SMTP autenticada por proceso.
+    Se reconecta de forma perezosa si la conexión falla o lleva demasiado tiempo inactiva.
+    """
+
+    def __init__(self, idle_timeout=100):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._server = None
+        self._key = None
+        self._last_used = 0.0
+
+    def _connect(self, cfg):
+        server = smtplib.SMTP(cfg.host, cfg.port)
+        server.starttls()
+        server.login(cfg.user, cfg.password)
+        return server
+
+    def _is_alive(self, key):
+        if self._server is None or self._key != key:
+            return False
+        if time.monotonic() - self._last_used > self.idle_timeout:
+            return False
+        try:
+            return self._server.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    def _close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except Exception:
+                pass
+        self._server = None
+        self._key = None
+
+    def send_message(self, cfg, msg):
+        """Envía el mensaje reutilizando la conexión existente cuando es posible."""
+        key = (cfg.host, cfg.port, cfg.user)
+        with self._lock:
+            if not self._is_alive(key):
+                self._close()
+                self._server = self._connect(cfg)
+                self._key = key
+            try:
+                self._server.send_message(msg)
+            except (smtplib.SMTPServerDisconnected, OSError):
+                # La conexión murió entre el NOOP y el envío: un único reintento.
+                self._close()
+                self._server = self._connect(cfg)
+                self._key = key
+                self._server.send_message(msg)
+            self._last_used = time.monotonic()
+
+
+_smtp_pool = _SMTPPool()
+
+
+@functools.lru_cache(maxsize=1)
+def _error_email_template():
+    """Mensaje base con From/To ya parseados; se copia para cada alerta."""
+    cfg = _error_email_cfg()
+    msg = EmailMessage()
+    msg['From'] = cfg.sender
+    msg['To'] = cfg.to
+    return msg
+
+
 def send_error_email(subject, body):
     """Envía un email de alerta en caso de error crítico."""
-    EMAIL_ENABLED = os.environ.get('ERROR_EMAIL_ENABLED', 'False').lower() == 'true'
-    if not EMAIL_ENABLED:
+    cfg = _error_email_cfg()
+    if not cfg.enabled:
         return
-    EMAIL_TO = os.environ.get('ERROR_EMAIL_TO')
-    EMAIL_FROM = os.environ.get('ERROR_EMAIL_FROM')
-    EMAIL_HOST = os.environ.get('ERROR_EMAIL_HOST')
-    EMAIL_PORT = int(os.environ.get('ERROR_EMAIL_PORT', 587))
-    EMAIL_USER = os.environ.get('ERROR_EMAIL_USER')
-    EMAIL_PASS = os.environ.get('ERROR_EMAIL_PASS')
-    if not all([EMAIL_TO, EMAIL_FROM, EMAIL_HOST, EMAIL_USER, EMAIL_PASS]):
+    if not cfg.is_complete:
         logging.error("Faltan variables de entorno para email de error.")
         return
     try:
-        msg = EmailMessage()
-        msg.set_content(body)
+        # deepcopy: una copia superficial compartiría la lista de cabeceras con la plantilla.
+        msg = copy.deepcopy(_error_email_template())
         msg['Subject'] = subject
-        msg['From'] = EMAIL_FROM
-        msg['To'] = EMAIL_TO
-        with smtplib.SMTP(EMAIL_HOST, EMAIL_PORT) as server:
-            server.starttls()
-            server.login(EMAIL_USER, EMAIL_PASS)
-            server.send_message(msg)
-        logging.info(f"Alerta de error enviada a {EMAIL_TO}")
+        msg.set_content(body)
+        _smtp_pool.send_message(cfg, msg)
+        logging.info(f"Alerta de error enviada a {cfg.to}")
     except Exception as e:
         logging.error(f"Error enviando email de alerta: {e}")
+
+
+# Pool pequeño para enviar alertas sin bloquear la respuesta 500 con el handshake SMTP.
+_error_email_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='error-email')
+
+
+def send_error_email_async(subject, body):
+    """Encola el envío del email de alerta en segundo plano."""
+    if not _error_email_cfg().enabled:
+        return None
+    return _error_email_executor.submit(send_error_email, subject, body)
 """
 DocuExpress - Sistema de Gestión de Papelerías
 Aplicación Flask principal con configuración mejorada y seguridad reforzada.
 """
-from flask import Flask, url_for, session, render_template, jsonify, current_app
+from flask import Flask, url_for, session, render_template, jsonify, current_app, g, request
+from flask.json.provider import DefaultJSONProvider
+import hashlib
 import logging
 import os
 import secrets
+import sqlite3
 from pathlib import Path
+from time import time as _time
 from markupsafe import Markup
 from flask_login import LoginManager, current_user
 from flask_wtf.csrf import CSRFProtect
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from datetime import datetime
-from sqlalchemy import text
+from sqlalchemy import text, inspect, event
+from sqlalchemy.schema import CreateColumn
 from dotenv import load_dotenv
 try:
     from flask_caching import Cache
@@ -57,34 +171,44 @@ try:
 except ImportError:
     FLASK_COMPRESS_AVAILABLE = False
 
+# Serialización JSON rápida con orjson (opcional)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 load_dotenv()
 
+# Instantánea del entorno tomada una sola vez (después de cargar .env).
+_ENV_SNAPSHOT = dict(os.environ)
+
+
+def _env(key, default=None):
+    """Lee una variable de entorno desde la instantánea del proceso."""
+    return _ENV_SNAPSHOT.get(key, default)
+
 # Importamos la clase DB y User
 # Se actualiza la importación para usar el nuevo módulo de base de datos.
 
 from ARCHIVOS.models import db, User
 from ARCHIVOS.backup_manager import backup_manager
 
-# Importa tus Blueprints
-# MEJORA DE ESTRUCTURA: Se actualizan las rutas de importación tras mover los archivos a la carpeta 'routes'.
-from ARCHIVOS.routes.config_routes import config_bp
-from ARCHIVOS.routes.api_routes import api_bp
-from ARCHIVOS.routes.auth_routes import auth_bp
-from ARCHIVOS.routes.papeleria_routes import papeleria_bp
-from ARCHIVOS.routes.gastos_routes import gastos_bp
-from ARCHIVOS.routes.main_routes import main_bp
-
 # ==================== CONFIGURACIÓN ====================
 
+# Evita repetir los mkdir de Config.init_app en cada create_app() del mismo proceso.
+_DIRS_READY = False
+
 class Config:
     """Configuración centralizada de la aplicación."""
     
     # Configuración básica
-    SECRET_KEY = os.environ.get('FLASK_SECRET_KEY') or secrets.token_hex(32)
-    DEBUG = os.environ.get('FLASK_DEBUG', 'False').lower() == 'true'
+    SECRET_KEY_FROM_ENV = bool(_env('FLASK_SECRET_KEY'))
+    SECRET_KEY = _env('FLASK_SECRET_KEY') or secrets.token_hex(32)
+    DEBUG = _env('FLASK_DEBUG', 'False').lower() == 'true'
     
     # Configuración de sesión
-    SESSION_COOKIE_SECURE = os.environ.get("SESSION_COOKIE_SECURE", "False").lower() == "true"
+    SESSION_COOKIE_SECURE = _env("SESSION_COOKIE_SECURE", "False").lower() == "true"
     SESSION_COOKIE_HTTPONLY = True
     SESSION_COOKIE_SAMESITE = 'Lax'
     PERMANENT_SESSION_LIFETIME = 3600 * 24 * 7  # 7 días
@@ -97,47 +221,59 @@ class Config:
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'pdf'}
     
     # Configuración de logging
-    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+    LOG_LEVEL = _env('LOG_LEVEL', 'INFO')
     LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    LOG_FILE = os.environ.get('LOG_FILE', 'docuexpress.log')
-    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 2 * 1024 * 1024))  # 2MB
-    LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+    LOG_FILE = _env('LOG_FILE', 'docuexpress.log')
+    LOG_MAX_BYTES = int(_env('LOG_MAX_BYTES', 2 * 1024 * 1024))  # 2MB
+    LOG_BACKUP_COUNT = int(_env('LOG_BACKUP_COUNT', 5))
     
     # Configuración de base de datos
     DATABASE_PATH = BASE_DIR / 'control_papelerias.db'
     SQLALCHEMY_DATABASE_URI = f"sqlite:///{DATABASE_PATH}"
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Caché de sentencias compiladas de SQLAlchemy 2.0 (por defecto 500 entradas)
+    SQLALCHEMY_ENGINE_OPTIONS = {'query_cache_size': 1200}
     
     # Configuración de seguridad
     WTF_CSRF_ENABLED = True
     WTF_CSRF_TIME_LIMIT = None  # No expira el token CSRF
     
     # Configuración de Rate Limiting
-    RATELIMIT_ENABLED = os.environ.get('RATELIMIT_ENABLED', 'True').lower() == 'true'
-    RATELIMIT_STORAGE_URL = os.environ.get('RATELIMIT_STORAGE_URL', 'redis://localhost:6379')
-    RATELIMIT_DEFAULT = os.environ.get('RATELIMIT_DEFAULT', '1000 per day;200 per hour')
-    RATELIMIT_API = os.environ.get('RATELIMIT_API', '500 per day;100 per hour')
+    RATELIMIT_ENABLED = _env('RATELIMIT_ENABLED', 'True').lower() == 'true'
+    RATELIMIT_STORAGE_URL = _env('RATELIMIT_STORAGE_URL', 'redis://localhost:6379')
+    RATELIMIT_DEFAULT = _env('RATELIMIT_DEFAULT', '1000 per day;200 per hour')
+    RATELIMIT_API = _env('RATELIMIT_API', '500 per day;100 per hour')
+    # Conexiones Redis reutilizables (el almacenamiento en memoria ignora esta opción)
+    RATELIMIT_STORAGE_OPTIONS = {'max_connections': int(_env('RATELIMIT_MAX_CONNECTIONS', '32'))}
 
     # Configuración de caché multicapa (OPTIMIZADO para PythonAnywhere gratis)
-    CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
-    CACHE_DEFAULT_TIMEOUT = int(os.environ.get('CACHE_DEFAULT_TIMEOUT', '300'))
-    CACHE_TYPE = 'SimpleCache'  # Mejor para PythonAnywhere gratis (sin Redis)
+    CACHE_REDIS_URL = _env('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+    CACHE_DEFAULT_TIMEOUT = int(_env('CACHE_DEFAULT_TIMEOUT', '300'))
+    # FileSystemCache se comparte entre todos los workers sin necesitar Redis
+    # (SimpleCache duplicaba la caché en cada proceso de PythonAnywhere).
+    CACHE_TYPE = _env('CACHE_TYPE', 'FileSystemCache')
+    CACHE_DIR = str(BASE_DIR / '.cache')
     CACHE_THRESHOLD = 500  # Máximo elementos en caché
     
     # Configuración de compresión (reduce transferencia 60-80%)
-    COMPRESS_MIMETYPES = [
+    COMPRESS_MIMETYPES = frozenset([
         'text/html', 'text/css', 'text/xml', 'text/javascript',
         'application/json', 'application/javascript', 'application/xml'
-    ]
+    ])
+    COMPRESS_ALGORITHM = ['br', 'gzip']  # Brotli si el navegador lo acepta, si no GZIP
+    COMPRESS_BR_LEVEL = 4
     COMPRESS_LEVEL = 6  # Balance entre compresión y CPU
-    COMPRESS_MIN_SIZE = 500  # Solo comprimir si > 500 bytes
+    COMPRESS_MIN_SIZE = 500  # Por debajo de ~500 bytes la cabecera y la CPU no compensan
     
     @staticmethod
     def init_app(app):
         """Inicializa la configuración de la aplicación."""
-        # Crear directorios necesarios
-        Config.UPLOAD_FOLDER.mkdir(parents=True, exist_ok=True)
-        Config.RECEIPTS_FOLDER.mkdir(parents=True, exist_ok=True)
+        # Crear directorios necesarios (una sola vez por proceso)
+        global _DIRS_READY
+        if not _DIRS_READY:
+            Config.UPLOAD_FOLDER.mkdir(parents=True, exist_ok=True)
+            Config.RECEIPTS_FOLDER.mkdir(parents=True, exist_ok=True)
+            _DIRS_READY = True
 
         # Configurar logging con rotación
         from logging.handlers import RotatingFileHandler
@@ -153,40 +289,132 @@ class Config:
         root_logger.addHandler(handler)
 
         # Advertencia si no hay SECRET_KEY configurado (solo en producción)
-        if not os.environ.get('FLASK_SECRET_KEY') and not app.config['DEBUG']:
+        if not Config.SECRET_KEY_FROM_ENV and not app.config['DEBUG']:
             logging.warning("\n" + "="*80)
             logging.warning("⚠️  ADVERTENCIA DE SEGURIDAD")
             logging.warning("No se configuró FLASK_SECRET_KEY. Se generó una automáticamente.")
             logging.warning("Para producción, configura FLASK_SECRET_KEY en el archivo .env")
             logging.warning("Genera una clave con: python3 -c 'import secrets; print(secrets.token_hex(32))'")
             logging.warning("="*80 + "\n")
-        elif os.environ.get('FLASK_SECRET_KEY'):
+        elif Config.SECRET_KEY_FROM_ENV:
             logging.info("✅ SECRET_KEY cargado desde variables de entorno")
 
 
+# ==================== JSON ====================
+
+class ORJSONProvider(DefaultJSONProvider):
+    """
+    Proveedor JSON de Flask basado en orjson; lo usan jsonify y request.get_json.
+    Fechas y tipos no nativos pasan por el `default` de Flask para conservar su formato.
+    """
+    _options = 0
+
+    def dumps(self, obj, **kwargs):
+        options = self._options
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=options).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        """Como jsonify: pero el cuerpo se entrega como bytes de orjson, sin decodificar a str y recodificar."""
+        obj = self._prepare_response_obj(args, kwargs)
+        options = self._options | orjson.OPT_APPEND_NEWLINE
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            options |= orjson.OPT_INDENT_2
+        body = orjson.dumps(obj, default=self.default, option=options)
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+if ORJSON_AVAILABLE:
+    ORJSONProvider._options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+
+
 # ==================== CREACIÓN DE LA APLICACIÓN ====================
 
+def _sqlite_pragmas(dbapi_connection, connection_record):
+    """WAL + busy_timeout: las lecturas concurrentes no se bloquean entre sí ni por una escritura en curso."""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA busy_timeout=5000')
+        cursor.close()
+
+
+def _schema_fingerprint():
+    """Huella del esquema declarado en los modelos (tablas, columnas e índices), como entero para PRAGMA user_version."""
+    parts = []
+    for table in sorted(db.metadata.tables.values(), key=lambda t: t.name):
+        columns = ','.join(sorted(c.name for c in table.columns))
+        indexes = ','.join(sorted(i.name for i in table.indexes if i.name))
+        parts.append(f"{table.name}:{columns}:{indexes}")
+    # 28 bits: cabe en el entero con signo de 32 bits de user_version y nunca es negativo
+    return int(hashlib.md5('|'.join(parts).encode()).hexdigest()[:7], 16)
+
+
+# Índices reemplazados por otros más amplios (su prefijo queda cubierto)
+_OBSOLETE_INDEXES = ('idx_tramites_user_papeleria',)
+
+
 def run_db_migration(app):
     """
     Realiza migraciones de base de datos simples y automáticas al inicio.
     Es idempotente, por lo que es seguro ejecutarlo en cada arranque.
+    Si el esquema no cambió desde la última migración (huella guardada en PRAGMA user_version
+    de la propia base) se omite create_all(); nunca se omite para bases en memoria o si el archivo no existe.
     """
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    db_path = app.config.get('DATABASE_PATH')
+    fingerprint = _schema_fingerprint()
+    can_skip = ':memory:' not in uri and db_path and Path(db_path).exists()
+
     with app.app_context():
+        if can_skip:
+            with db.engine.connect() as conn:
+                if conn.exec_driver_sql('PRAGMA user_version').scalar() == fingerprint:
+                    return
+
         # La migración de la columna is_active se maneja directamente en el modelo.
         # Para cambios de esquema más complejos, se recomienda usar una herramienta de migración como Alembic.
         # Por ahora, solo se asegura que la tabla se cree con la columna si no existe.
         db.create_all()
+        # create_all() no añade columnas calculadas ni índices nuevos a tablas que ya existen
+        inspector = inspect(db.engine)
+        with db.engine.begin() as conn:
+            for table in db.metadata.sorted_tables:
+                existentes = {c['name'] for c in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.computed is not None and column.name not in existentes:
+                        ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+                        conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {ddl}'))
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=db.engine, checkfirst=True)
+        with db.engine.begin() as conn:
+            for nombre in _OBSOLETE_INDEXES:
+                conn.execute(text(f'DROP INDEX IF EXISTS {nombre}'))
+            # Estadísticas actualizadas para que el planificador de SQLite elija los índices nuevos
+            conn.execute(text('ANALYZE'))
+            if ':memory:' not in uri:
+                # PRAGMA no admite parámetros; fingerprint es un entero calculado aquí
+                conn.exec_driver_sql(f'PRAGMA user_version = {fingerprint}')
 
 
 def create_app(config_class=Config):
 
     app = Flask(__name__)
     app.config.from_object(config_class)
+    if ORJSON_AVAILABLE:
+        app.json = ORJSONProvider(app)
 
     # ✅ 0. Inicializar Compresión GZIP PRIMERO (antes de cualquier ruta)
     if FLASK_COMPRESS_AVAILABLE:
         Compress(app)
-        logging.info("✅ Compresión GZIP habilitada")
+        logging.info("✅ Compresión Brotli/GZIP habilitada")
 
     # ✅ 1. Inicializar configuración PRIMERO
     config_class.init_app(app)
@@ -196,6 +424,8 @@ def create_app(config_class=Config):
     if not app.config.get('TESTING', False):
         CSRFProtect(app)
     db.init_app(app)
+    with app.app_context():
+        event.listen(db.engine, 'connect', _sqlite_pragmas)
     # ✅ 3. Inicializar caché multicapa
     # Intentamos usar el backend indicado en configuración (por defecto Redis).
     # Si falla (p. ej. Redis no está disponible en desarrollo) caemos a SimpleCache.
@@ -213,9 +443,8 @@ def create_app(config_class=Config):
     @app.route('/cache-test')
     @cache.cached(timeout=60)
     def cache_test():
-        from time import time
         return jsonify({
-            'cached_time': time(),
+            'cached_time': _time(),
             'message': 'Si este valor no cambia en 60 segundos, la caché funciona.'
         })
 
@@ -229,7 +458,7 @@ def create_app(config_class=Config):
                 key_func=get_remote_address,
                 default_limits=[app.config.get('RATELIMIT_DEFAULT', '1000 per day')],
                 storage_uri=storage_uri,
-                strategy='fixed-window'
+                strategy='moving-window'
             )
             logging.info("✅ Rate Limiting habilitado (%s)", storage_uri)
             logging.info(f"   Límites por defecto: {app.config.get('RATELIMIT_DEFAULT')}")
@@ -243,7 +472,7 @@ def create_app(config_class=Config):
                     key_func=get_remote_address,
                     default_limits=[app.config.get('RATELIMIT_DEFAULT', '1000 per day')],
                     storage_uri='memory://',
-                    strategy='fixed-window'
+                    strategy='moving-window'
                 )
                 app.limiter = limiter
             except Exception as e2:
@@ -268,20 +497,40 @@ def create_app(config_class=Config):
     register_error_handlers(app)
     register_blueprints(app)
 
-    @app.route('/health')
-    def health_check():
+    # Importado aquí por la misma razón que los Blueprints (ver register_blueprints)
+    from ARCHIVOS.utils import get_effective_user_id, bump_data_version
+
+    @app.after_request
+    def invalidar_cache_de_datos(response):
+        """Tras cualquier escritura exitosa se invalidan las respuestas cacheadas del usuario."""
+        if request.method in ('POST', 'PUT', 'PATCH', 'DELETE') and response.status_code < 400:
+            user_id = get_effective_user_id()
+            if user_id is not None:
+                bump_data_version(user_id)
+        return response
+
+    @cache.memoize(timeout=5)
+    def _probe_database():
+        """Ejecuta SELECT 1; el resultado se reutiliza durante 5 segundos entre probes."""
         try:
             db.session.execute(text('SELECT 1'))
+            return {'ok': True, 'error': None}
+        except Exception as e:
+            return {'ok': False, 'error': str(e)}
+
+    @app.route('/health')
+    def health_check():
+        probe = _probe_database()
+        if probe['ok']:
             return jsonify({
                 'status': 'healthy',
                 'timestamp': datetime.now().isoformat(),
                 'database': 'connected'
             }), 200
-        except Exception as e:
-            return jsonify({
-                'status': 'unhealthy',
-                'error': str(e)
-            }), 500
+        return jsonify({
+            'status': 'unhealthy',
+            'error': probe['error']
+        }), 500
 
     return app
 
@@ -300,13 +549,29 @@ def setup_login_manager(app):
     @login_manager.user_loader
     def load_user(user_id):
         """Carga un usuario desde la base de datos."""
-        return db.session.get(User, int(user_id))
+        from ARCHIVOS.database import user_repository
+        return user_repository.get_by_id(int(user_id))
+
+    @app.teardown_request
+    def clear_user_cache(exc=None):
+        """Descarta el caché de usuarios de la petición (el contexto de app puede sobrevivirla)."""
+        g.pop('user_cache', None)
 
 
 # ==================== CONTEXT PROCESSORS ====================
 
+@functools.lru_cache(maxsize=1)
+def _current_year(hour_bucket):
+    """Año actual, recalculado como mucho una vez por hora (la clave cambia cada hora)."""
+    return datetime.now().year
+
+
 def register_context_processors(app):
-    """Registra context processors para templates."""
+    """
+    Registra context processors para templates.
+    Los globales que usa cada processor se enlazan como argumentos por defecto
+    al registrarlo, así cada render los lee como variables locales.
+    """
     
     @app.context_processor
     def utility_processor():
@@ -315,48 +580,52 @@ def register_context_processors(app):
             field_id = kwargs.pop('id', field.id)
             field_class = kwargs.pop('class', '')
             
-            # Añadir 'is-invalid' si hay errores
-            if field.errors:
-                field_class += ' is-invalid'
+            # Camino rápido: sin errores no hay que construir el bloque de feedback
+            if not field.errors:
+                return Markup(field(id=field_id, class_=field_class, **kwargs))
             
-            # Renderizar el campo
-            rendered_field = field(id=field_id, class_=field_class, **kwargs)
-            
-            # Construir el HTML del error
-            error_html = ''
-            if field.errors:
-                error_html = f'<div class="invalid-feedback">{" ".join(field.errors)}</div>'
+            # Añadir 'is-invalid' y el HTML del error
+            rendered_field = field(id=field_id, class_=field_class + ' is-invalid', **kwargs)
+            error_html = f'<div class="invalid-feedback">{" ".join(field.errors)}</div>'
             
             return Markup(f"{rendered_field}{error_html}")
         return dict(render_field=render_field)
     @app.context_processor
-    def inject_current_year():
+    def inject_current_year(_current_year=_current_year, _time=_time):
         """Inyecta el año actual en todos los templates."""
-        return {'current_year': datetime.now().year}
+        return {'current_year': _current_year(int(_time() // 3600))}
     
     @app.context_processor
-    def inject_logo():
+    def inject_logo(session=session, g=g):
         """Inyecta la ruta del logo del usuario actual."""
         # MEJORA: Usar la sesión para evitar comprobaciones de archivo en cada request.
         # Se asume que 'session["has_logo"]' y 'session["user_id"]' se establecen
         # durante el login o al subir/eliminar el logo.
+        if 'logo_path' in g:
+            return {'logo_path': g.logo_path}
         logo_path = None
         if session.get('has_logo') and session.get('user_id'):
-            logo_filename = f"logo_{session['user_id']}.png"
-            logo_path = url_for('static', filename=f'uploads/{logo_filename}')
+            logo_path = url_for('static', filename=f"uploads/logo_{session['user_id']}.png")
+        g.logo_path = logo_path
         return {'logo_path': logo_path}
     
     @app.context_processor
-    def inject_impersonation_status():
+    def inject_impersonation_status(session=session):
         """Inyecta el estado de suplantación de identidad en los templates."""
         if 'original_user_id' in session:
-            from ARCHIVOS.models import User # Importación local para evitar dependencia circular
-            viewing_user_id = session.get('viewing_user_id')
-            user = db.session.get(User, viewing_user_id)
-            if user:
+            # El nombre se guarda en la sesión al iniciar la suplantación (auth.view_user_dashboard);
+            # solo se consulta la BD si falta, y se guarda para los siguientes renders.
+            username = session.get('viewing_user_name')
+            if not username:
+                from ARCHIVOS.database import user_repository
+                user = user_repository.get_by_id(session.get('viewing_user_id'))
+                if user:
+                    username = user.username
+                    session['viewing_user_name'] = username
+            if username:
                 return {
                     'is_impersonating': True,
-                    'impersonated_user_name': user.username
+                    'impersonated_user_name': username
                 }
         return {'is_impersonating': False}
 
@@ -365,12 +634,17 @@ def register_context_processors(app):
 
 def register_error_handlers(app):
     """Registra manejadores de errores personalizados."""
+    # Plantillas de error compiladas una sola vez; render_template acepta objetos
+    # Template y sigue aplicando los context processors.
+    error_templates = {
+        code: app.jinja_env.get_template(f'errors/{code}.html') for code in (403, 404, 500)
+    }
     
     @app.errorhandler(404)
     def not_found_error(error):
         """Maneja errores 404 - Página no encontrada."""
         logging.warning(f"404 error: {error}")
-        return render_template('errors/404.html'), 404
+        return render_template(error_templates[404]), 404
     
     @app.errorhandler(500)
     def internal_error(error):
@@ -380,18 +654,18 @@ def register_error_handlers(app):
             db.session.rollback()
         except Exception as e:
             logging.error(f"Error during DB rollback on 500 error: {e}")
-        # Enviar alerta por email
-        send_error_email(
+        # Enviar alerta por email en segundo plano
+        send_error_email_async(
             subject="DocuExpress - Error 500",
             body=f"Error interno del servidor: {error}"
         )
-        return render_template('errors/500.html'), 500
+        return render_template(error_templates[500]), 500
     
     @app.errorhandler(403)
     def forbidden_error(error):
         """Maneja errores 403 - Acceso prohibido."""
         logging.warning(f"403 error: {error}")
-        return render_template('errors/403.html'), 403
+        return render_template(error_templates[403]), 403
     
     @app.errorhandler(413)
     def request_entity_too_large(error):
@@ -405,6 +679,15 @@ def register_error_handlers(app):
 # ==================== REGISTRO DE BLUEPRINTS ====================
 
 def register_blueprints(app):
+    # Los Blueprints se importan aquí (y no al cargar el módulo) para que importar
+    # ARCHIVOS.app no arrastre todas las rutas, formularios y repositorios.
+    from ARCHIVOS.routes.config_routes import config_bp
+    from ARCHIVOS.routes.api_routes import api_bp
+    from ARCHIVOS.routes.auth_routes import auth_bp
+    from ARCHIVOS.routes.papeleria_routes import papeleria_bp
+    from ARCHIVOS.routes.gastos_routes import gastos_bp
+    from ARCHIVOS.routes.main_routes import main_bp
+
     blueprints = [
         (auth_bp, 'Autenticación'),
         (papeleria_bp, 'Papelerías'),
@@ -4,8 +4,9 @@ Gestiona backups programados de la base de datos SQLite
 """
 
 import os
-import shutil
+import sqlite3
 import logging
+from contextlib import closing
 from pathlib import Path
 from datetime import datetime, timedelta
 from apscheduler.schedulers.background import BackgroundScheduler
@@ -43,8 +44,8 @@ class BackupManager:
         self.db_path = Path(app.config.get('DATABASE_PATH'))
         self.retention_days = int(os.environ.get('BACKUP_RETENTION_DAYS', '30'))
         
-        # Crear directorio de backups
-        self.backup_dir.mkdir(parents=True, exist_ok=True)
+        # El directorio se crea al generar el primer backup (en el hilo del scheduler),
+        # así el arranque del worker no espera operaciones de disco.
         
         # Iniciar scheduler
         self._start_scheduler()
@@ -94,6 +95,12 @@ class BackupManager:
         self.scheduler.start()
         logger.info("✅ Scheduler de backups iniciado")
     
+    @staticmethod
+    def _copy_database(origen, destino):
+        """Copia una base SQLite con la API de backup: incluye lo que siga en el -wal y respeta los bloqueos."""
+        with closing(sqlite3.connect(origen)) as src, closing(sqlite3.connect(destino)) as dst:
+            src.backup(dst)
+
     def create_backup(self, manual=False):
         """Crea un backup de la base de datos."""
         if not self.enabled and not manual:
@@ -106,13 +113,15 @@ class BackupManager:
                 logger.error(f"❌ Base de datos no encontrada: {self.db_path}")
                 return None
             
+            self.backup_dir.mkdir(parents=True, exist_ok=True)
+            
             # Generar nombre del backup con timestamp
             timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
             backup_filename = f"control_papelerias_backup_{timestamp}.db"
             backup_path = self.backup_dir / backup_filename
             
             # Copiar base de datos
-            shutil.copy2(self.db_path, backup_path)
+            self._copy_database(self.db_path, backup_path)
             
             # Verificar integridad del backup
             if backup_path.exists() and backup_path.stat().st_size > 0:
@@ -163,6 +172,8 @@ class BackupManager:
     def list_backups(self):
         """Lista todos los backups disponibles."""
         backups = []
+        if not self.backup_dir or not self.backup_dir.exists():
+            return backups
         
         for backup_file in sorted(self.backup_dir.glob('control_papelerias_backup_*.db'), reverse=True):
             try:
@@ -195,11 +206,11 @@ class BackupManager:
             
             # Crear backup de seguridad antes de restaurar
             safety_backup = self.db_path.parent / f"{self.db_path.stem}_before_restore_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db"
-            shutil.copy2(self.db_path, safety_backup)
+            self._copy_database(self.db_path, safety_backup)
             logger.info(f"🔒 Backup de seguridad creado: {safety_backup.name}")
             
-            # Restaurar
-            shutil.copy2(backup_path, self.db_path)
+            # Restaurar sobre la base en uso (las conexiones abiertas ven el contenido nuevo)
+            self._copy_database(backup_path, self.db_path)
             logger.info(f"✅ Base de datos restaurada desde: {backup_filename}")
             
             return True
@@ -43,6 +43,9 @@ TRAMITES_PREDEFINIDOS = [
     'VIX'
 ]
 
+# Versión inmutable para búsquedas de pertenencia y uniones de conjuntos
+TRAMITES_PREDEFINIDOS_SET = frozenset(TRAMITES_PREDEFINIDOS)
+
 CATEGORIAS_GASTOS = [
     ('SERVICIOS', 'Servicios (Luz, Agua, Internet)'),
     ('RENTA', 'Renta de Local'),
@@ -5,21 +5,119 @@ Cada repositorio es responsable de la lógica de negocio de un único modelo,
 asegurando un código limpio, mantenible y desacoplado de la capa de rutas.
 """
 
-from .models import db, User, Papeleria, Tramite, Gasto, Proveedor, TramiteCosto, PapeleriaPrecio
+from .models import db, User, Papeleria, Tramite, Gasto, Proveedor, TramiteCosto, PapeleriaPrecio, TramiteMonthlyRollup
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy import func, case
-from datetime import datetime
+from sqlalchemy.orm import contains_eager
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import func, case, and_, collate, exists, insert, update, delete, select, union_all, literal, bindparam, true, cast, Float, Integer, String, Date
+from datetime import datetime, date
 import logging
+from flask import g, has_app_context
 
 from .constants import TRAMITES_PREDEFINIDOS
 
+# Sentencias de consulta frecuentes construidas una sola vez; su clave de caché
+# en SQLAlchemy es estable, así que la compilación se reutiliza entre llamadas.
+_USER_BY_USERNAME = select(User).where(User.username == bindparam('username'))
+
+_PAPELERIA_DISTRIBUTION = select(
+    Tramite.tramite.label('tramite_label'),
+    func.count(Tramite.id).label('total_count')
+).where(Tramite.user_id == bindparam('user_id'), Tramite.papeleria_id == bindparam('papeleria_id'))\
+ .group_by(Tramite.tramite)\
+ .order_by(db.desc('total_count'))\
+ .limit(bindparam('limit'))
+
+# Consultas de una fila que el formulario de trámites pide en cada selección (precio y costo por defecto)
+_DEFAULT_PRECIO = select(PapeleriaPrecio.precio)\
+ .join(Papeleria, PapeleriaPrecio.papeleria_id == Papeleria.id)\
+ .where(
+    PapeleriaPrecio.papeleria_id == bindparam('papeleria_id'),
+    PapeleriaPrecio.tramite == bindparam('tramite'),
+    Papeleria.user_id == bindparam('user_id'),
+    Papeleria.is_active == True
+ )
+
+_COSTO_TRAMITE = select(TramiteCosto.costo)\
+ .where(TramiteCosto.user_id == bindparam('user_id'), TramiteCosto.tramite == bindparam('tramite'))
+
+_TOTAL_GASTOS = select(func.coalesce(func.sum(Gasto.monto), 0)).where(Gasto.user_id == bindparam('user_id'))
+
+
+def _build_papeleria_monthly():
+    """
+    Resumen mensual de una papelería: los meses se generan en SQL (CTE recursivo) y se unen con el
+    resumen mensual, así la BD devuelve exactamente una fila por mes, ordenada y con ceros en los
+    meses sin actividad. La ganancia por mes y los totales (SUM() OVER ()) también salen de la BD.
+    El mes en curso se suma desde los trámites con fecha <= hasta, sin contar los de fecha futura.
+    Parámetros: user_id, papeleria_id, inicio y ultimo_mes ('YYYY-MM-01'), mes_inicio y mes_fin ('YYYY-MM'),
+    hasta (date).
+    """
+    meses = select(bindparam('inicio', type_=String).label('inicio')).cte('meses', recursive=True)
+    meses = meses.union_all(
+        select(func.date(meses.c.inicio, '+1 month')).where(meses.c.inicio < bindparam('ultimo_mes', type_=String))
+    )
+    meses_completos = select(
+        TramiteMonthlyRollup.month.label('mes'),
+        TramiteMonthlyRollup.ingresos.label('ingresos'),
+        TramiteMonthlyRollup.costos.label('gastos')
+    ).where(
+        TramiteMonthlyRollup.user_id == bindparam('user_id'),
+        TramiteMonthlyRollup.papeleria_id == bindparam('papeleria_id'),
+        TramiteMonthlyRollup.month >= bindparam('mes_inicio'),
+        TramiteMonthlyRollup.month < bindparam('mes_fin')
+    )
+    mes_en_curso = select(
+        Tramite.mes.label('mes'),
+        func.sum(Tramite.precio).label('ingresos'),
+        func.sum(Tramite.costo).label('gastos')
+    ).where(
+        Tramite.user_id == bindparam('user_id'),
+        Tramite.papeleria_id == bindparam('papeleria_id'),
+        Tramite.mes == bindparam('mes_fin'),
+        Tramite.fecha <= bindparam('hasta', type_=Date)
+    ).group_by(Tramite.mes)
+    agregados = union_all(meses_completos, mes_en_curso).subquery()
+    mes = func.strftime('%Y-%m', meses.c.inicio)
+    ingresos = func.coalesce(agregados.c.ingresos, 0)
+    gastos = func.coalesce(agregados.c.gastos, 0)
+    return select(
+        mes.label('month'),
+        ingresos.label('ingresos'),
+        gastos.label('gastos'),
+        (ingresos - gastos).label('ganancias'),
+        func.sum(ingresos).over().label('total_ingresos'),
+        func.sum(gastos).over().label('total_gastos')
+    ).select_from(meses)\
+     .outerjoin(agregados, agregados.c.mes == mes)\
+     .order_by(meses.c.inicio)
+
+
+_PAPELERIA_MONTHLY = _build_papeleria_monthly()
+
+
+def _as_date(fecha):
+    """Acepta un date o un texto 'YYYY-MM-DD' (formularios) y devuelve el date."""
+    return date.fromisoformat(fecha) if isinstance(fecha, str) else fecha
+
+
+def _user_cache():
+    """Devuelve el caché de usuarios del contexto actual (vive solo durante la petición)."""
+    if not has_app_context():
+        return None
+    if 'user_cache' not in g:
+        g.user_cache = {}
+    return g.user_cache
+
+
 class UserRepository:
     """
     Repository for User related operations.
+    Lookups by id and username are memoized on flask.g for the duration of the request.
     """
     def create(self, username, password, role='employee'):
         """Creates a new user."""
-        if User.query.filter_by(username=username).first():
+        if self.get_by_username(username):
             raise ValueError(f"El usuario '{username}' ya existe.")
         
         new_user = User(username=username, role=role)
@@ -27,15 +125,37 @@ class UserRepository:
         
         db.session.add(new_user)
         db.session.commit()
+        self._invalidate(username=username)
         return new_user
 
     def get_by_username(self, username):
         """Gets a user by username."""
-        return User.query.filter_by(username=username).first()
+        cache = _user_cache()
+        key = ('username', username)
+        if cache is not None and key in cache:
+            return cache[key]
+        user = db.session.execute(_USER_BY_USERNAME, {'username': username}).scalar_one_or_none()
+        if cache is not None:
+            cache[key] = user
+        return user
 
     def get_by_id(self, user_id):
         """Gets a user by id."""
-        return db.session.get(User, user_id)
+        cache = _user_cache()
+        key = ('id', user_id)
+        if cache is not None and key in cache:
+            return cache[key]
+        user = db.session.get(User, user_id)
+        if cache is not None:
+            cache[key] = user
+        return user
+
+    def _invalidate(self, user_id=None, username=None):
+        """Drops memoized lookups after a user is created, renamed or deleted."""
+        cache = _user_cache()
+        if cache is not None:
+            cache.pop(('id', user_id), None)
+            cache.pop(('username', username), None)
 
     def get_all_except(self, admin_user_id):
         """Gets all users except the given admin."""
@@ -51,11 +171,13 @@ class UserRepository:
         """Updates a user's details."""
         user = self.get_by_id(user_id)
         if user:
+            self._invalidate(username=user.username)
             user.username = username
             user.role = role
             if password:
                 user.set_password(password)
             db.session.commit()
+            self._invalidate(username=username)
             return user
         return None
 
@@ -65,6 +187,7 @@ class UserRepository:
         if user:
             db.session.delete(user)
             db.session.commit()
+            self._invalidate(user_id=user_id, username=user.username)
             return True
         return False
 
@@ -121,14 +244,23 @@ class PapeleriaRepository:
             func.sum(Tramite.costo).label('total_costos')
         ).filter(Tramite.user_id == user_id).group_by(Tramite.papeleria_id).subquery()
 
-        # Main query to get papelerias and join the stats
+        cuantos = func.coalesce(papeleria_stats_sq.c.cuantos, 0)
+        ingresos = func.coalesce(papeleria_stats_sq.c.total_ingresos, 0)
+        costos = func.coalesce(papeleria_stats_sq.c.total_costos, 0)
+
+        # Main query to get papelerias and join the stats.
+        # Los totales generales salen de funciones de ventana (SUM() OVER ()) sobre las mismas filas
+        # filtradas; SQLite no soporta ROLLUP.
         query = db.session.query(
             Papeleria.id,
             Papeleria.nombre,
-            func.coalesce(papeleria_stats_sq.c.cuantos, 0).label('cuantos'),
-            func.coalesce(papeleria_stats_sq.c.total_ingresos, 0).label('total_ingresos'),
-            func.coalesce(papeleria_stats_sq.c.total_costos, 0).label('total_costos'),
-            (func.coalesce(papeleria_stats_sq.c.total_ingresos, 0) - func.coalesce(papeleria_stats_sq.c.total_costos, 0)).label('ganancia_total')
+            cuantos.label('cuantos'),
+            ingresos.label('total_ingresos'),
+            costos.label('total_costos'),
+            (ingresos - costos).label('ganancia_total'),
+            func.sum(cuantos).over().label('gran_cuantos'),
+            func.sum(ingresos).over().label('gran_ingresos'),
+            func.sum(costos).over().label('gran_costos')
         ).filter(Papeleria.is_active == True).outerjoin(papeleria_stats_sq, Papeleria.id == papeleria_stats_sq.c.papeleria_id)\
          .filter(Papeleria.user_id == user_id)
 
@@ -136,18 +268,19 @@ class PapeleriaRepository:
             query = query.filter(Papeleria.nombre.like(f'%{search_term}%'))
 
         papelerias = query.order_by(Papeleria.nombre).all()
-        
-        # Calculate totals from the retrieved papelerias list
-        total_cuantos = sum(p.cuantos for p in papelerias)
-        total_ingresos = sum(p.total_ingresos for p in papelerias)
-        total_costos = sum(p.total_costos for p in papelerias)
-        total_ganancia = total_ingresos - total_costos
+
+        if papelerias:
+            total_cuantos = papelerias[0].gran_cuantos
+            total_ingresos = papelerias[0].gran_ingresos
+            total_costos = papelerias[0].gran_costos
+        else:
+            total_cuantos = total_ingresos = total_costos = 0
 
         totales = {
             'cuantos': total_cuantos,
             'total_ingresos': total_ingresos,
             'total_costos': total_costos,
-            'ganancia': total_ganancia
+            'ganancia': total_ingresos - total_costos
         }
         
         return {'papelerias': papelerias, 'totales': totales}
@@ -165,36 +298,28 @@ class PapeleriaRepository:
         inicio_mes_anterior = inicio_mes_actual - relativedelta(months=1)
         fin_mes_anterior = inicio_mes_actual - relativedelta(days=1)
         
-        # Datos mes actual
-        datos_actual = db.session.query(
-            func.sum(Tramite.precio).label('ingresos'),
-            func.sum(Tramite.costo).label('costos')
-        ).join(Papeleria, Tramite.papeleria_id == Papeleria.id)\
-         .filter(
-            Tramite.user_id == user_id,
-            Papeleria.is_active == True,
-            Tramite.fecha >= inicio_mes_actual
-        ).first()
-        
-        # Datos mes anterior
-        datos_anterior = db.session.query(
-            func.sum(Tramite.precio).label('ingresos'),
-            func.sum(Tramite.costo).label('costos')
+        # Un solo recorrido del índice (user_id, fecha) para ambos meses
+        es_mes_actual = Tramite.fecha >= inicio_mes_actual
+        es_mes_anterior = and_(Tramite.fecha >= inicio_mes_anterior, Tramite.fecha <= fin_mes_anterior)
+        datos = db.session.query(
+            func.sum(case((es_mes_actual, Tramite.precio), else_=0)).label('ingresos_actual'),
+            func.sum(case((es_mes_actual, Tramite.costo), else_=0)).label('costos_actual'),
+            func.sum(case((es_mes_anterior, Tramite.precio), else_=0)).label('ingresos_anterior'),
+            func.sum(case((es_mes_anterior, Tramite.costo), else_=0)).label('costos_anterior')
         ).join(Papeleria, Tramite.papeleria_id == Papeleria.id)\
          .filter(
             Tramite.user_id == user_id,
             Papeleria.is_active == True,
-            Tramite.fecha >= inicio_mes_anterior,
-            Tramite.fecha <= fin_mes_anterior
-        ).first()
+            Tramite.fecha >= inicio_mes_anterior
+        ).one()
         
         # Calcular valores
-        ingresos_actual = float(datos_actual.ingresos or 0)
-        costos_actual = float(datos_actual.costos or 0)
+        ingresos_actual = float(datos.ingresos_actual or 0)
+        costos_actual = float(datos.costos_actual or 0)
         ganancia_actual = ingresos_actual - costos_actual
         
-        ingresos_anterior = float(datos_anterior.ingresos or 0)
-        costos_anterior = float(datos_anterior.costos or 0)
+        ingresos_anterior = float(datos.ingresos_anterior or 0)
+        costos_anterior = float(datos.costos_anterior or 0)
         ganancia_anterior = ingresos_anterior - costos_anterior
         
         # Calcular porcentajes de cambio
@@ -230,28 +355,28 @@ class PapeleriaRepository:
          .limit(limit)
         
         # Convert rows to dictionaries
-        return [row._asdict() for row in query.all()]
+        return [dict(row) for row in db.session.execute(query.statement).mappings()]
 
     def update_name(self, papeleria_id, nuevo_nombre, user_id):
         """Updates the name of a papeleria."""
-        papeleria = Papeleria.query.filter_by(id=papeleria_id, user_id=user_id, is_active=True).first()
-        if papeleria:
-            papeleria.nombre = nuevo_nombre.strip().upper()
-            db.session.commit()
+        Papeleria.query.filter_by(id=papeleria_id, user_id=user_id, is_active=True)\
+            .update({'nombre': nuevo_nombre.strip().upper()}, synchronize_session=False)
+        db.session.commit()
 
     def delete(self, papeleria_id, user_id):
         """Soft deletes a papeleria by setting is_active to False."""
-        papeleria = Papeleria.query.filter_by(id=papeleria_id, user_id=user_id, is_active=True).first()
-        if papeleria:
-            papeleria.is_active = False
-            db.session.commit()
+        Papeleria.query.filter_by(id=papeleria_id, user_id=user_id, is_active=True)\
+            .update({'is_active': False}, synchronize_session=False)
+        db.session.commit()
 
     def exists_with_name(self, nombre, user_id, papeleria_id_to_exclude=None):
         """Checks if an *active* papeleria with the given name already exists for the user."""
-        query = Papeleria.query.filter_by(nombre=nombre.strip().upper(), user_id=user_id, is_active=True)
+        condicion = exists().where(
+            Papeleria.nombre == nombre.strip().upper(), Papeleria.user_id == user_id, Papeleria.is_active == True
+        )
         if papeleria_id_to_exclude:
-            query = query.filter(Papeleria.id != papeleria_id_to_exclude)
-        return query.first() is not None
+            condicion = condicion.where(Papeleria.id != papeleria_id_to_exclude)
+        return db.session.execute(select(condicion)).scalar()
 
     def get_name(self, papeleria_id, user_id):
         """Gets the name of a papeleria."""
@@ -264,10 +389,7 @@ class PapeleriaRepository:
         'precios_data' is a dictionary of {'tramite_name': 'price_string'}.
         """
         logging.info(f"set_precios_bulk iniciado para papeleria_id={papeleria_id}")
-        if not Papeleria.query.filter_by(id=papeleria_id, user_id=user_id, is_active=True).first():
-            logging.warning("Intento de acceso no autorizado o papelería no existe.")
-            return None, ["La papelería no existe o no tienes permiso."]
-
+        sin_permiso = ["La papelería no existe o no tienes permiso."]
         errors = []
         valid_precios = {}
         for tramite, precio_str in precios_data.items():
@@ -291,23 +413,34 @@ class PapeleriaRepository:
 
         try:
             logging.info("Validación exitosa. Iniciando transacción de base de datos.")
-            # 1. Obtener precios existentes en una sola consulta para eficiencia
-            existing_precios_objs = PapeleriaPrecio.query.filter_by(papeleria_id=papeleria_id).all()
-            existing_precios_map = {p.tramite: p for p in existing_precios_objs}
-
-            # 2. Iterar sobre los precios validados y actualizar o crear según sea necesario
+            # UPSERT de todos los precios en una sola sentencia sobre la restricción única
+            # (papeleria_id, tramite). Las filas salen de un SELECT sobre la papelería filtrado por
+            # dueño y estado activo, así que la verificación de permisos viaja en la misma sentencia.
             logging.info(f"Procesando {len(valid_precios)} precios válidos.")
-            for tramite, precio in valid_precios.items():
-                precio_obj = existing_precios_map.get(tramite)
-                if precio_obj:
-                    # Actualizar precio existente
-                    precio_obj.precio = precio
-                else:
-                    # Crear nuevo registro de precio
-                    new_precio = PapeleriaPrecio(papeleria_id=papeleria_id, tramite=tramite, precio=precio)
-                    db.session.add(new_precio)
+            if valid_precios:
+                filas = [
+                    select(literal(tramite, String).label('tramite'), literal(precio, Float).label('precio'))
+                    for tramite, precio in valid_precios.items()
+                ]
+                nuevos = (union_all(*filas) if len(filas) > 1 else filas[0]).subquery('nuevos')
+                origen = select(Papeleria.id, nuevos.c.tramite, nuevos.c.precio)\
+                    .select_from(Papeleria).join(nuevos, true()).where(
+                    Papeleria.id == papeleria_id, Papeleria.user_id == user_id, Papeleria.is_active == True
+                )
+                stmt = sqlite_insert(PapeleriaPrecio).from_select(['papeleria_id', 'tramite', 'precio'], origen)
+                stmt = stmt.on_conflict_do_update(
+                    index_elements=['papeleria_id', 'tramite'],
+                    set_={'precio': stmt.excluded.precio}
+                )
+                if db.session.execute(stmt).rowcount == 0:
+                    db.session.rollback()
+                    logging.warning("Intento de acceso no autorizado o papelería no existe.")
+                    return None, sin_permiso
+            elif not Papeleria.query.filter_by(id=papeleria_id, user_id=user_id, is_active=True).first():
+                logging.warning("Intento de acceso no autorizado o papelería no existe.")
+                return None, sin_permiso
             
-            # 3. Confirmar todos los cambios en la base de datos
+            # Confirmar todos los cambios en la base de datos
             logging.info(f"A punto de hacer commit para {len(valid_precios)} precios.")
             db.session.commit()
             logging.info("Commit exitoso.")
@@ -323,22 +456,42 @@ class PapeleriaRepository:
 
     def get_default_precio(self, papeleria_id, tramite, user_id):
         """Gets the default price for a tramite."""
-        precio_obj = PapeleriaPrecio.query.join(Papeleria).filter(
-            PapeleriaPrecio.papeleria_id == papeleria_id, Papeleria.is_active == True,
-            PapeleriaPrecio.tramite == tramite,
-            Papeleria.user_id == user_id
-        ).first()
-        return precio_obj.precio if precio_obj else None
+        params = {'papeleria_id': papeleria_id, 'tramite': tramite, 'user_id': user_id}
+        return db.session.execute(_DEFAULT_PRECIO, params).scalar()
 
     def get_precios_para_papeleria(self, papeleria_id, user_id):
-        """Gets all prices and costs for a given papeleria."""
-        
-        costos_generales = {c.tramite: c.costo for c in TramiteCosto.query.filter_by(user_id=user_id).all()}
-        precios_especificos = {p.tramite: p.precio for p in PapeleriaPrecio.query.join(Papeleria).filter(PapeleriaPrecio.papeleria_id == papeleria_id, Papeleria.is_active == True).all()}
-        
-        todos_los_tramites = sorted(list(set(TRAMITES_PREDEFINIDOS) | set(costos_generales.keys()) | set(precios_especificos.keys())))
-        
-        return {tramite: {'costo_general': costos_generales.get(tramite), 'precio_especifico': precios_especificos.get(tramite)} for tramite in todos_los_tramites}
+        """
+        Gets all prices and costs for a given papeleria.
+        General costs and papeleria-specific prices are merged in SQL (UNION ALL + GROUP BY)
+        so a single round trip returns one row per tramite.
+        """
+        costos = select(
+            TramiteCosto.tramite.label('tramite'),
+            TramiteCosto.costo.label('costo_general'),
+            literal(None, Float).label('precio_especifico')
+        ).where(TramiteCosto.user_id == user_id)
+
+        precios = select(
+            PapeleriaPrecio.tramite,
+            literal(None, Float),
+            PapeleriaPrecio.precio
+        ).join(Papeleria, PapeleriaPrecio.papeleria_id == Papeleria.id)\
+         .where(PapeleriaPrecio.papeleria_id == papeleria_id, Papeleria.is_active == True)
+
+        merged = union_all(costos, precios).subquery()
+        rows = db.session.execute(
+            select(
+                merged.c.tramite,
+                func.max(merged.c.costo_general).label('costo_general'),
+                func.max(merged.c.precio_especifico).label('precio_especifico')
+            ).group_by(merged.c.tramite)
+        ).all()
+
+        resultado = {tramite: {'costo_general': None, 'precio_especifico': None} for tramite in TRAMITES_PREDEFINIDOS}
+        for row in rows:
+            resultado[row.tramite] = {'costo_general': row.costo_general, 'precio_especifico': row.precio_especifico}
+
+        return {tramite: resultado[tramite] for tramite in sorted(resultado)}
 
     def total_por_papeleria(self, papeleria_id, user_id, fecha_inicio=None, fecha_fin=None):
         """Calculates totals for a specific papeleria."""
@@ -364,45 +517,45 @@ class PapeleriaRepository:
         }
     
     def get_all_papelerias(self, user_id):
-        """Gets all active papelerias for search functionality."""
+        """Gets all active papelerias with their configured price count, in a single query."""
+        precios_count_sq = db.session.query(
+            PapeleriaPrecio.papeleria_id,
+            func.count(PapeleriaPrecio.id).label('precios_count')
+        ).group_by(PapeleriaPrecio.papeleria_id).subquery()
+
         papelerias = db.session.query(
             Papeleria.id,
-            Papeleria.nombre
-        ).filter(
+            Papeleria.nombre,
+            func.coalesce(precios_count_sq.c.precios_count, 0).label('precios_count')
+        ).outerjoin(precios_count_sq, Papeleria.id == precios_count_sq.c.papeleria_id)\
+         .filter(
             Papeleria.user_id == user_id,
             Papeleria.is_active == True
         ).order_by(Papeleria.nombre).all()
-        
-        result = []
-        for p in papelerias:
-            # Contar precios configurados
-            precios_count = PapeleriaPrecio.query.filter_by(papeleria_id=p.id).count()
-            result.append({
-                'id': p.id,
-                'nombre': p.nombre,
-                'precios': [{'tramite': '', 'precio': 0}] * precios_count  # Lista simulada para el count
-            })
-        
-        return result
+
+        return [{'id': p.id, 'nombre': p.nombre, 'precios_count': p.precios_count} for p in papelerias]
 
 class TramiteRepository:
     """Repository for Tramite and TramiteCosto related operations."""
 
-    def add_bulk(self, papeleria_id, tramite, user_id, fecha, precio, costo, cantidad):
-        """Registers multiple tramites in a single transaction."""
-        fecha_dt = datetime.strptime(fecha, "%Y-%m-%d")
-
-        for _ in range(cantidad):
-            new_tramite = Tramite(
-                papeleria_id=papeleria_id,
-                tramite=tramite,
-                user_id=user_id,
-                fecha=fecha_dt,
-                precio=float(precio),
-                costo=float(costo)
-            )
-            db.session.add(new_tramite)
-        db.session.commit()
+    def add_bulk(self, papeleria_id, tramite, user_id, fecha, precio, costo, cantidad, commit=True):
+        """
+        Registers multiple tramites in a single transaction.
+        Uses a Core executemany INSERT so no ORM objects are tracked per row.
+        With commit=False the rows stay in the caller's transaction, so several
+        calls can be grouped and committed (or rolled back) together.
+        """
+        row = {
+            'papeleria_id': papeleria_id,
+            'tramite': tramite,
+            'user_id': user_id,
+            'fecha': _as_date(fecha),
+            'precio': float(precio),
+            'costo': float(costo)
+        }
+        db.session.execute(insert(Tramite), [row] * cantidad)
+        if commit:
+            db.session.commit()
 
     def get_by_id(self, tramite_id, user_id):
         """Gets a single tramite by its ID."""
@@ -412,7 +565,7 @@ class TramiteRepository:
         """Updates an existing tramite."""
         tramite_obj = self.get_by_id(tramite_id, user_id)
         if tramite_obj:
-            fecha_dt = datetime.strptime(fecha, "%Y-%m-%d")
+            fecha_dt = _as_date(fecha)
             tramite_obj.fecha = fecha_dt
             tramite_obj.tramite = tramite
             tramite_obj.precio = float(precio)
@@ -421,17 +574,23 @@ class TramiteRepository:
 
     def delete(self, tramite_id, user_id):
         """Deletes a tramite and returns the associated papeleria_id."""
-        tramite = self.get_by_id(tramite_id, user_id)
-        if tramite:
-            papeleria_id = tramite.papeleria_id
-            db.session.delete(tramite)
-            db.session.commit()
-            return papeleria_id
-        return None
+        stmt = delete(Tramite).where(Tramite.id == tramite_id, Tramite.user_id == user_id)
+        if db.engine.dialect.delete_returning:
+            papeleria_id = db.session.execute(stmt.returning(Tramite.papeleria_id)).scalar_one_or_none()
+        else:
+            # SQLite < 3.35 no soporta RETURNING
+            papeleria_id = db.session.execute(
+                select(Tramite.papeleria_id).where(Tramite.id == tramite_id, Tramite.user_id == user_id)
+            ).scalar_one_or_none()
+            if papeleria_id is not None:
+                db.session.execute(stmt)
+        db.session.commit()
+        return papeleria_id
 
     def get_details_for_papeleria(self, papeleria_id, user_id, fecha_inicio=None, fecha_fin=None, page=1, per_page=20):
         """Gets a paginated list of tramites for a specific papeleria."""
-        query = Tramite.query.join(Papeleria).filter(Tramite.papeleria_id == papeleria_id, Tramite.user_id == user_id, Papeleria.is_active == True)
+        # contains_eager reutiliza el JOIN para poblar tramite.papeleria sin consultas extra
+        query = Tramite.query.join(Papeleria).options(contains_eager(Tramite.papeleria)).filter(Tramite.papeleria_id == papeleria_id, Tramite.user_id == user_id, Papeleria.is_active == True)
 
         if fecha_inicio and fecha_fin:
             query = query.filter(Tramite.fecha.between(fecha_inicio, fecha_fin))
@@ -441,16 +600,16 @@ class TramiteRepository:
 
     def get_total_general(self, user_id, fecha_inicio=None, fecha_fin=None):
         """Calculates grand totals for a user."""
-        query = db.session.query(
+        stmt = select(
             func.count(Tramite.id).label('cuantos'), # type: ignore
             func.sum(func.coalesce(Tramite.precio, 0)).label('total_ingresos'),
             func.sum(func.coalesce(Tramite.costo, 0)).label('total_costos')
-        ).filter(Tramite.user_id == user_id)
+        ).where(Tramite.user_id == user_id)
 
         if fecha_inicio and fecha_fin:
-            query = query.filter(Tramite.fecha.between(fecha_inicio, fecha_fin))
+            stmt = stmt.where(Tramite.fecha.between(fecha_inicio, fecha_fin))
 
-        result = query.one()
+        result = db.session.execute(stmt).one()
         ingresos = float(result.total_ingresos or 0)
         costos = float(result.total_costos or 0)
         return {
@@ -462,24 +621,26 @@ class TramiteRepository:
 
     def get_tramites_hoy(self, user_id):
         """Returns the number of tramites registered today."""
-        hoy_str = datetime.now().strftime("%Y-%m-%d")
-        return Tramite.query.filter(Tramite.fecha == hoy_str, Tramite.user_id == user_id).count()
+        # `fecha` es una columna Date: comparar con un objeto date usa el índice (user_id, fecha).
+        return db.session.execute(
+            select(func.count(Tramite.id)).where(Tramite.user_id == user_id, Tramite.fecha == date.today())
+        ).scalar()
     
     def get_all_tramites(self, user_id, limit=100):
         """Gets recent tramites for search functionality."""
-        tramites = db.session.query(
+        tramites = db.session.execute(select(
             Tramite.id,
             Tramite.tramite,
             Tramite.fecha,
             Tramite.precio,
             Tramite.costo,
-            (Tramite.precio - Tramite.costo).label('ganancia'),
+            Tramite.ganancia,
             Papeleria.nombre.label('papeleria')
         ).join(Papeleria, Tramite.papeleria_id == Papeleria.id)\
-         .filter(Tramite.user_id == user_id, Papeleria.is_active == True)\
+         .where(Tramite.user_id == user_id, Papeleria.is_active == True)\
          .order_by(Tramite.fecha.desc(), Tramite.id.desc())\
-         .limit(limit)\
-         .all()
+         .limit(limit)
+        )
         
         return [{
             'id': t.id,
@@ -497,15 +658,16 @@ class TramiteRepository:
         hoy = datetime.now().date()
         ayer = hoy - timedelta(days=1)
         
-        tramites_hoy = Tramite.query.filter(
-            Tramite.fecha == hoy.strftime("%Y-%m-%d"), 
-            Tramite.user_id == user_id
-        ).count()
-        
-        tramites_ayer = Tramite.query.filter(
-            Tramite.fecha == ayer.strftime("%Y-%m-%d"), 
-            Tramite.user_id == user_id
-        ).count()
+        # Ambos conteos en una sola consulta sobre el índice (user_id, fecha)
+        conteos = db.session.query(
+            func.sum(case((Tramite.fecha == hoy, 1), else_=0)).label('hoy'),
+            func.sum(case((Tramite.fecha == ayer, 1), else_=0)).label('ayer')
+        ).filter(
+            Tramite.user_id == user_id,
+            Tramite.fecha.in_([hoy, ayer])
+        ).one()
+        tramites_hoy = conteos.hoy or 0
+        tramites_ayer = conteos.ayer or 0
         
         cambio = tramites_hoy - tramites_ayer
         porcentaje = ((cambio / tramites_ayer) * 100) if tramites_ayer > 0 else (100 if tramites_hoy > 0 else 0)
@@ -518,18 +680,22 @@ class TramiteRepository:
         }
 
     def export_all_as_csv(self, user_id):
-        """Exports all tramites for a user to be used in a CSV."""
+        """
+        Exports all tramites for a user to be used in a CSV.
+        Returns a query that streams rows in batches of 1000 instead of a materialized list.
+        """
         return db.session.query(
             Papeleria.nombre.label('papeleria'),
             Tramite.tramite,
             Tramite.fecha,
             Tramite.precio,
             Tramite.costo,
-            (Tramite.precio - Tramite.costo).label('ganancia')
+            Tramite.ganancia
         ).join(Papeleria, (Tramite.papeleria_id == Papeleria.id) & (Papeleria.is_active == True))\
          .filter(Tramite.user_id == user_id)\
          .order_by(Tramite.fecha.desc())\
-         .all()
+         .execution_options(stream_results=True)\
+         .yield_per(1000)
 
     def get_all_costos(self, user_id):
         """Gets all defined tramite costs for a user."""
@@ -538,17 +704,17 @@ class TramiteRepository:
 
     def get_costo_for_tramite(self, tramite, user_id):
         """Gets the cost for a specific tramite."""
-        costo = TramiteCosto.query.filter_by(tramite=tramite, user_id=user_id).first()
-        return costo.costo if costo else None
+        return db.session.execute(_COSTO_TRAMITE, {'tramite': tramite, 'user_id': user_id}).scalar()
 
     def set_costo(self, tramite, costo, user_id):
         """Sets or updates the default cost for a tramite."""
-        costo_obj = TramiteCosto.query.filter_by(tramite=tramite, user_id=user_id).first()
-        if costo_obj:
-            costo_obj.costo = float(costo)
-        else:
-            costo_obj = TramiteCosto(tramite=tramite, costo=float(costo), user_id=user_id)
-            db.session.add(costo_obj)
+        # UPSERT sobre la restricción única (user_id, tramite): una sola sentencia exista o no el costo
+        stmt = sqlite_insert(TramiteCosto).values(tramite=tramite, costo=float(costo), user_id=user_id)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['user_id', 'tramite'],
+            set_={'costo': stmt.excluded.costo}
+        )
+        db.session.execute(stmt)
         db.session.commit()
 
     def get_distinct_tramites(self, user_id):
@@ -556,18 +722,23 @@ class TramiteRepository:
         return [r[0] for r in db.session.query(Tramite.tramite).filter_by(user_id=user_id).distinct().order_by(Tramite.tramite).all()]
 
     def update_old_costos(self, user_id):
-        """Updates the cost of old tramites (where cost is 0) using default cost values."""
-        costos_default = self.get_all_costos(user_id)
-        if not costos_default:
-            return 0
-        
-        count = 0
-        for tramite, costo in costos_default.items():
-            updated_rows = Tramite.query.filter_by(tramite=tramite, costo=0, user_id=user_id).update({'costo': costo})
-            count += updated_rows
-        
+        """
+        Updates the cost of old tramites (where cost is 0) using default cost values.
+        A single UPDATE with a correlated subquery replaces one UPDATE per tramite type
+        (portable to SQLite versions without UPDATE ... FROM).
+        """
+        costo_default = select(TramiteCosto.costo).where(
+            TramiteCosto.user_id == user_id,
+            TramiteCosto.tramite == Tramite.tramite
+        ).scalar_subquery()
+
+        stmt = update(Tramite)\
+            .where(Tramite.user_id == user_id, Tramite.costo == 0, costo_default.isnot(None))\
+            .values(costo=costo_default)\
+            .execution_options(synchronize_session=False)
+        result = db.session.execute(stmt)
         db.session.commit()
-        return count
+        return result.rowcount
 
     def get_monthly_summary(self, user_id, fecha_inicio=None, fecha_fin=None):
         """
@@ -589,15 +760,14 @@ class TramiteRepository:
             - 'totals': A dictionary with 'total_ingresos', 'total_gastos', and 'total_ganancia'
               for the entire 12-month period.
         """
-        from datetime import date, datetime
+        from datetime import date
         from dateutil.relativedelta import relativedelta
-        from collections import defaultdict
 
         # 1. Generate the date range
         if fecha_inicio and fecha_fin:
             # Usar rango personalizado
-            start_date = datetime.strptime(fecha_inicio, '%Y-%m-%d').date()
-            end_date = datetime.strptime(fecha_fin, '%Y-%m-%d').date()
+            start_date = date.fromisoformat(fecha_inicio)
+            end_date = date.fromisoformat(fecha_fin)
             start_date = start_date.replace(day=1)
         else:
             # Usar últimos 12 meses por defecto
@@ -611,46 +781,80 @@ class TramiteRepository:
             months.append(current_date.strftime('%Y-%m'))
             current_date += relativedelta(months=1)
 
-        # 2. Get data from Tramites (Ingresos and Costos)
-        tramites_query = db.session.query(
-            func.strftime('%Y-%m', Tramite.fecha).label('month'),
-            func.sum(Tramite.precio).label('total_ingresos'),
-            func.sum(Tramite.costo).label('total_costos_tramite')
-        ).join(Papeleria, Tramite.papeleria_id == Papeleria.id)\
-         .filter(
-            Tramite.user_id == user_id,
-            Papeleria.is_active == True,
-            Tramite.fecha >= start_date,
-            Tramite.fecha <= end_date
-        ).group_by('month').all()
-
-        # 3. Get data from Gastos
-        gastos_query = db.session.query(
-            func.strftime('%Y-%m', Gasto.fecha).label('month'),
-            func.sum(Gasto.monto).label('total_gastos_generales')
-        ).filter(
-            Gasto.user_id == user_id,
-            Gasto.fecha >= start_date,
-            Gasto.fecha <= end_date
-        ).group_by('month').all()
-
-        # 4. Process and combine data
-        monthly_summary = defaultdict(lambda: {'ingresos': 0, 'gastos': 0})
+        if not months:
+            # Rango invertido (fecha_inicio posterior a fecha_fin): series vacías
+            return {
+                'monthly_data': [],
+                'totals': {'total_ingresos': 0, 'total_gastos': 0, 'total_ganancia': 0}
+            }
 
-        for row in tramites_query:
-            monthly_summary[row.month]['ingresos'] += row.total_ingresos
-            monthly_summary[row.month]['gastos'] += row.total_costos_tramite
+        # 2. Tramites (ingresos y costos) y Gastos se agregan por mes en una sola consulta (UNION ALL).
+        #    Se filtra por la columna 'mes' (no por fecha) para que el índice (user_id, mes) sirva tanto
+        #    para el rango como para el GROUP BY, sin ordenar en una tabla temporal.
+        #    Los meses completos salen del resumen mensual; si el rango termina a mitad de mes
+        #    (también el rango por defecto, que termina hoy) ese último mes se suma desde las filas
+        #    con fecha <= end_date, para no contar registros con fecha futura.
+        mes_parcial = (end_date + relativedelta(days=1)).day != 1
+        meses_completos = months[:-1] if mes_parcial else months
+        selects = []
+        if meses_completos:
+            selects.append(select(
+                TramiteMonthlyRollup.month.label('month'),
+                func.sum(TramiteMonthlyRollup.ingresos).label('ingresos'),
+                func.sum(TramiteMonthlyRollup.costos).label('gastos')
+            ).join(Papeleria, TramiteMonthlyRollup.papeleria_id == Papeleria.id)\
+             .where(
+                TramiteMonthlyRollup.user_id == user_id,
+                Papeleria.is_active == True,
+                TramiteMonthlyRollup.month >= meses_completos[0],
+                TramiteMonthlyRollup.month <= meses_completos[-1]
+            ).group_by('month'))
+        if mes_parcial:
+            selects.append(select(
+                Tramite.mes.label('month'),
+                func.sum(Tramite.precio).label('ingresos'),
+                func.sum(Tramite.costo).label('gastos')
+            ).join(Papeleria, Tramite.papeleria_id == Papeleria.id)\
+             .where(
+                Tramite.user_id == user_id,
+                Papeleria.is_active == True,
+                Tramite.mes == months[-1],
+                Tramite.fecha <= end_date
+            ).group_by('month'))
+
+        gastos_select = select(
+            Gasto.mes.label('month'),
+            literal(0).label('ingresos'),
+            func.sum(Gasto.monto).label('gastos')
+        ).where(
+            Gasto.user_id == user_id,
+            Gasto.mes >= months[0],
+            Gasto.mes <= months[-1]
+        ).group_by('month')
+        if mes_parcial:
+            gastos_select = gastos_select.where(Gasto.fecha <= end_date)
+        selects.append(gastos_select)
+
+        merged = union_all(*selects).subquery()
+        rows = db.session.execute(
+            select(
+                merged.c.month,
+                func.sum(merged.c.ingresos).label('ingresos'),
+                func.sum(merged.c.gastos).label('gastos')
+            ).group_by(merged.c.month)
+        ).all()
+
+        # 3. Index results by month
+        monthly_summary = {row.month: {'ingresos': row.ingresos, 'gastos': row.gastos} for row in rows}
+        vacio = {'ingresos': 0, 'gastos': 0}
 
-        for row in gastos_query:
-            monthly_summary[row.month]['gastos'] += row.total_gastos_generales
-        
-        # 5. Build final list and calculate totals
+        # 4. Build final list and calculate totals
         final_data = []
         total_ingresos = 0
         total_gastos = 0
 
         for month_str in months:
-            data = monthly_summary[month_str]
+            data = monthly_summary.get(month_str, vacio)
             ingresos = data['ingresos']
             gastos = data['gastos']
             ganancias = ingresos - gastos
@@ -679,32 +883,26 @@ class TramiteRepository:
 
     def get_tramites_distribution(self, user_id, limit=10, fecha_inicio=None, fecha_fin=None):
         """Gets the distribution of tramites by count, optionally filtered by date range."""
-        query = db.session.query(
+        stmt = select(
             Tramite.tramite.label('tramite_label'),
             func.count(Tramite.id).label('total_count')
         ).join(Papeleria, Tramite.papeleria_id == Papeleria.id)\
-         .filter(Tramite.user_id == user_id)\
-         .filter(Papeleria.is_active == True)
+         .where(Tramite.user_id == user_id)\
+         .where(Papeleria.is_active == True)
         
         # Aplicar filtro de fecha si se proporciona
         if fecha_inicio and fecha_fin:
-            query = query.filter(Tramite.fecha >= fecha_inicio, Tramite.fecha <= fecha_fin)
+            stmt = stmt.where(Tramite.fecha >= fecha_inicio, Tramite.fecha <= fecha_fin)
         
-        query = query.group_by(Tramite.tramite)\
+        stmt = stmt.group_by(Tramite.tramite)\
          .order_by(db.desc('total_count'))\
          .limit(limit)
-        return [row._asdict() for row in query.all()]
+        return [dict(row) for row in db.session.execute(stmt).mappings()]
 
     def get_tramites_distribution_for_papeleria(self, papeleria_id, user_id, limit=10):
         """Gets the distribution of tramites for a specific papeleria."""
-        query = db.session.query(
-            Tramite.tramite.label('tramite_label'), # type: ignore
-            func.count(Tramite.id).label('total_count')
-        ).filter(Tramite.user_id == user_id, Tramite.papeleria_id == papeleria_id)\
-         .group_by(Tramite.tramite)\
-         .order_by(db.desc('total_count'))\
-         .limit(limit)
-        return [row._asdict() for row in query.all()]
+        params = {'user_id': user_id, 'papeleria_id': papeleria_id, 'limit': limit}
+        return [dict(row) for row in db.session.execute(_PAPELERIA_DISTRIBUTION, params).mappings()]
 
     def get_monthly_summary_for_papeleria(self, papeleria_id, user_id):
         """
@@ -718,60 +916,32 @@ class TramiteRepository:
         Returns:
             A dictionary with 'monthly_data' and 'totals'.
         """
-        from datetime import date
         from dateutil.relativedelta import relativedelta
-        from collections import defaultdict
 
-        # 1. Generate the last 12 months
+        # 1. Last 12 months range
         end_date = date.today()
-        start_date = end_date - relativedelta(months=11)
-        start_date = start_date.replace(day=1)
-
-        months = []
-        current_date = start_date
-        while current_date <= end_date:
-            months.append(current_date.strftime('%Y-%m'))
-            current_date += relativedelta(months=1)
-
-        # 2. Get data from Tramites for this specific papeleria
-        tramites_query = db.session.query(
-            func.strftime('%Y-%m', Tramite.fecha).label('month'), # type: ignore
-            func.sum(Tramite.precio).label('total_ingresos'),
-            func.sum(Tramite.costo).label('total_costos')
-        ).filter(
-            Tramite.user_id == user_id,
-            Tramite.papeleria_id == papeleria_id,
-            Tramite.fecha >= start_date,
-            Tramite.fecha <= end_date
-        ).group_by('month').all()
-
-        # 3. Process data
-        monthly_summary = defaultdict(lambda: {'ingresos': 0, 'gastos': 0})
-        for row in tramites_query:
-            monthly_summary[row.month]['ingresos'] = row.total_ingresos
-            monthly_summary[row.month]['gastos'] = row.total_costos
-
-        # 4. Build final list and calculate totals
-        final_data = []
-        total_ingresos = 0
-        total_gastos = 0
-
-        for month_str in months:
-            data = monthly_summary[month_str]
-            ingresos = data['ingresos']
-            gastos = data['gastos']
-            ganancias = ingresos - gastos
-            
-            final_data.append({
-                'month': month_str,
-                'ingresos': ingresos,
-                'gastos': gastos,
-                'ganancias': ganancias
-            })
-            
-            total_ingresos += ingresos
-            total_gastos += gastos
-            
+        start_date = (end_date - relativedelta(months=11)).replace(day=1)
+
+        # 2. Meses generados en SQL y unidos al resumen mensual (ver _PAPELERIA_MONTHLY)
+        rows = db.session.execute(_PAPELERIA_MONTHLY, {
+            'user_id': user_id,
+            'papeleria_id': papeleria_id,
+            'inicio': start_date.isoformat(),
+            'ultimo_mes': end_date.replace(day=1).isoformat(),
+            'mes_inicio': start_date.strftime('%Y-%m'),
+            'mes_fin': end_date.strftime('%Y-%m'),
+            'hasta': end_date
+        }).all()
+
+        # 3. Build final list
+        final_data = [{
+            'month': row.month,
+            'ingresos': row.ingresos,
+            'gastos': row.gastos,
+            'ganancias': row.ganancias
+        } for row in rows]
+        total_ingresos = rows[0].total_ingresos
+        total_gastos = rows[0].total_gastos
         total_ganancia = total_ingresos - total_gastos
 
         return {
@@ -793,7 +963,7 @@ class ProveedorRepository:
 
     def add(self, nombre, user_id):
         try:
-            new_proveedor = Proveedor(nombre=nombre.strip().upper(), user_id=user_id)
+            new_proveedor = Proveedor(nombre=nombre.strip(), user_id=user_id)
             db.session.add(new_proveedor)
             db.session.commit()
             return new_proveedor
@@ -802,7 +972,7 @@ class ProveedorRepository:
             return None
 
     def get_all(self, user_id):
-        return Proveedor.query.filter_by(user_id=user_id).order_by(Proveedor.nombre).all()
+        return Proveedor.query.filter_by(user_id=user_id).order_by(collate(Proveedor.nombre, 'NOCASE')).all()
 
     def get_by_id(self, proveedor_id, user_id):
         return Proveedor.query.filter_by(id=proveedor_id, user_id=user_id).first()
@@ -810,7 +980,7 @@ class ProveedorRepository:
     def update(self, proveedor_id, nombre, user_id):
         proveedor = self.get_by_id(proveedor_id, user_id)
         if proveedor:
-            proveedor.nombre = nombre.strip().upper()
+            proveedor.nombre = nombre.strip()
             db.session.commit()
 
     def delete(self, proveedor_id, user_id):
@@ -820,26 +990,46 @@ class ProveedorRepository:
             db.session.commit()
 
     def is_in_use(self, proveedor_id, user_id):
-        return Gasto.query.filter_by(proveedor_id=proveedor_id, user_id=user_id).first() is not None
+        return db.session.execute(select(
+            exists().where(Gasto.proveedor_id == proveedor_id, Gasto.user_id == user_id)
+        )).scalar()
 
 class GastoRepository:
     """Repository for Gasto related operations."""
 
     def add(self, proveedor_id, descripcion, monto, fecha, categoria, user_id, receipt_filename=None):
-        fecha_dt = datetime.strptime(fecha, "%Y-%m-%d")
-        new_gasto = Gasto(
-            proveedor_id=proveedor_id,
-            descripcion=descripcion,
-            monto=float(monto),
-            fecha=fecha_dt,
-            categoria=categoria,
-            user_id=user_id,
-            receipt_filename=receipt_filename
-        )
-        db.session.add(new_gasto)
-        db.session.commit()
-
-    def get_all(self, user_id, page=1, per_page=20, fecha_inicio=None, fecha_fin=None, categoria=None):
+        self.add_many(user_id, [{
+            'proveedor_id': proveedor_id,
+            'descripcion': descripcion,
+            'monto': monto,
+            'fecha': fecha,
+            'categoria': categoria,
+            'receipt_filename': receipt_filename
+        }])
+
+    def add_many(self, user_id, rows, commit=True):
+        """
+        Registers several gastos for a user in a single transaction.
+        Each row is a dict with proveedor_id, descripcion, monto, fecha (date or YYYY-MM-DD), categoria
+        and optionally receipt_filename. Uses a Core executemany INSERT (no ORM unit of work).
+        With commit=False the insert is left in the caller's transaction.
+        """
+        valores = [{
+            'proveedor_id': row['proveedor_id'],
+            'descripcion': row.get('descripcion'),
+            'monto': float(row['monto']),
+            'fecha': _as_date(row['fecha']),
+            'categoria': row.get('categoria') or 'OTROS',
+            'user_id': user_id,
+            'receipt_filename': row.get('receipt_filename')
+        } for row in rows]
+        if valores:
+            db.session.execute(insert(Gasto), valores)
+            if commit:
+                db.session.commit()
+        return len(valores)
+
+    def _filtered(self, user_id, fecha_inicio=None, fecha_fin=None, categoria=None):
         query = Gasto.query.filter_by(user_id=user_id)
 
         if fecha_inicio and fecha_fin:
@@ -847,13 +1037,27 @@ class GastoRepository:
 
         if categoria:
             query = query.filter_by(categoria=categoria)
-        
-        pagination = query.join(Proveedor).order_by(Gasto.fecha.desc(), Gasto.id.desc()).paginate(page=page, per_page=per_page, error_out=False)
+
+        return query.join(Proveedor)
+
+    def get_all(self, user_id, page=1, per_page=20, fecha_inicio=None, fecha_fin=None, categoria=None, count=True):
+        """
+        Returns a page of gastos and the total number of matching rows.
+        With count=False the COUNT(*) query is skipped and the total is None
+        (for callers that already know it, e.g. from cache).
+        """
+        # contains_eager reutiliza el JOIN con Proveedor para poblar gasto.proveedor sin una consulta por fila
+        query = self._filtered(user_id, fecha_inicio, fecha_fin, categoria).options(contains_eager(Gasto.proveedor))
+        pagination = query.order_by(Gasto.fecha.desc(), Gasto.id.desc()).paginate(page=page, per_page=per_page, error_out=False, count=count)
         return pagination.items, pagination.total
+
+    def count_all(self, user_id, fecha_inicio=None, fecha_fin=None, categoria=None):
+        """Counts the gastos matching the same filters as get_all."""
+        return self._filtered(user_id, fecha_inicio, fecha_fin, categoria).order_by(None).count()
     
     def get_all_gastos(self, user_id, limit=100):
         """Gets recent gastos for search functionality."""
-        gastos = db.session.query(
+        gastos = db.session.execute(select(
             Gasto.id,
             Gasto.descripcion.label('concepto'),
             Gasto.monto,
@@ -861,10 +1065,10 @@ class GastoRepository:
             Gasto.categoria,
             Proveedor.nombre.label('proveedor')
         ).join(Proveedor, Gasto.proveedor_id == Proveedor.id)\
-         .filter(Gasto.user_id == user_id)\
+         .where(Gasto.user_id == user_id)\
          .order_by(Gasto.fecha.desc(), Gasto.id.desc())\
-         .limit(limit)\
-         .all()
+         .limit(limit)
+        )
         
         return [{
             'id': g.id,
@@ -877,7 +1081,7 @@ class GastoRepository:
 
     def get_total_gastos(self, user_id):
         """Calculates the total amount of all expenses for a user."""
-        return db.session.query(func.sum(Gasto.monto)).filter_by(user_id=user_id).scalar() or 0
+        return db.session.execute(_TOTAL_GASTOS, {'user_id': user_id}).scalar()
 
     def get_by_id(self, gasto_id, user_id):
         return Gasto.query.filter_by(id=gasto_id, user_id=user_id).first()
@@ -888,7 +1092,7 @@ class GastoRepository:
             gasto.proveedor_id = proveedor_id
             gasto.descripcion = descripcion
             gasto.monto = float(monto)
-            gasto.fecha = datetime.strptime(fecha, "%Y-%m-%d")
+            gasto.fecha = _as_date(fecha)
             gasto.categoria = categoria
             gasto.receipt_filename = receipt_filename
             db.session.commit()
@@ -900,7 +1104,9 @@ class GastoRepository:
             db.session.commit()
 
     def does_receipt_belong_to_user(self, filename, user_id):
-        return Gasto.query.filter_by(receipt_filename=filename, user_id=user_id).first() is not None
+        return db.session.execute(select(
+            exists().where(Gasto.receipt_filename == filename, Gasto.user_id == user_id)
+        )).scalar()
 
     def get_gastos_distribution(self, user_id, fecha_inicio=None, fecha_fin=None):
         """Gets the distribution of gastos by categoria, optionally filtered by date range."""
@@ -915,7 +1121,7 @@ class GastoRepository:
         
         query = query.group_by(Gasto.categoria)\
          .order_by(db.desc('total_monto'))
-        return [row._asdict() for row in query.all()]
+        return [dict(row) for row in db.session.execute(query.statement).mappings()]
 
     def get_gastos_summary(self, user_id, fecha_inicio=None, fecha_fin=None, categoria=None):
         """Gets a summary of gastos based on filters."""
@@ -933,28 +1139,91 @@ class GastoRepository:
 
 
 # ==================== REPOSITORIO DE ANÁLISIS AVANZADO ====================
+def _build_dashboard_bundle():
+    """
+    UNION ALL con todas las métricas del dashboard (ver AnalyticsRepository.get_dashboard_bundle).
+    Parámetros: user_id y mes_actual ('YYYY-MM').
+    """
+    base = select(
+        Tramite.tramite, Tramite.fecha, Tramite.mes, Tramite.precio, Tramite.costo, Tramite.ganancia,
+        Papeleria.id.label('papeleria_id'), Papeleria.nombre, Papeleria.is_active
+    ).join(Papeleria, Tramite.papeleria_id == Papeleria.id)\
+     .where(Tramite.user_id == bindparam('user_id')).cte('base')
+    activos = base.c.is_active == True
+    ganancia = base.c.ganancia
+    resumen = select(
+        TramiteMonthlyRollup.month, TramiteMonthlyRollup.ingresos, TramiteMonthlyRollup.costos,
+        TramiteMonthlyRollup.count, Papeleria.id.label('papeleria_id'), Papeleria.nombre, Papeleria.is_active
+    ).join(Papeleria, TramiteMonthlyRollup.papeleria_id == Papeleria.id)\
+     .where(TramiteMonthlyRollup.user_id == bindparam('user_id')).cte('resumen')
+    resumen_activos = resumen.c.is_active == True
+    ganancia_mes = resumen.c.ingresos - resumen.c.costos
+
+    def rama(k, label=None, n=None, a=None, b=None):
+        return [
+            literal(k).label('k'),
+            (label if label is not None else literal(None, String)).label('label'),
+            (n if n is not None else literal(None, Integer)).label('n'),
+            (a if a is not None else literal(None, Float)).label('a'),
+            (b if b is not None else literal(None, Float)).label('b'),
+        ]
+
+    totales = select(*rama(
+        'totales',
+        a=func.sum(case((and_(resumen_activos, resumen.c.month >= bindparam('mes_actual')), ganancia_mes))),
+        b=func.round(func.coalesce(func.sum(resumen.c.costos) / func.sum(resumen.c.count), 0), 2)
+    ))
+    margen = select(*rama(
+        'margen', a=func.sum(resumen.c.ingresos), b=func.sum(resumen.c.costos)
+    )).where(resumen_activos)
+    mejor_mes = select(*rama('mes', label=resumen.c.month, a=func.sum(ganancia_mes)))\
+        .where(resumen_activos).group_by(resumen.c.month).order_by(db.desc('a')).limit(1).subquery()
+    dias = select(*rama(
+        'dia', label=func.strftime('%w', base.c.fecha), n=func.count(), a=func.sum(ganancia)
+    )).where(activos).group_by(func.strftime('%w', base.c.fecha))
+    ingresos_pap, costos_pap = func.sum(resumen.c.ingresos), func.sum(resumen.c.costos)
+    roi_pap = (ingresos_pap - costos_pap) / costos_pap * 100
+    roi = select(*rama(
+        'roi', label=resumen.c.nombre, a=func.round(roi_pap, 1)
+    )).where(resumen_activos).group_by(resumen.c.papeleria_id, resumen.c.nombre)\
+        .having(costos_pap > 0).order_by(db.desc(roi_pap)).limit(5).subquery()
+    rentabilidad = select(*rama(
+        'tramite', label=base.c.tramite, n=func.count(),
+        a=func.round(func.coalesce(func.avg(ganancia), 0), 2),
+        b=func.round(func.coalesce(func.sum(ganancia), 0), 2)
+    )).where(activos).group_by(base.c.tramite)
+
+    return union_all(totales, margen, select(mejor_mes), dias, select(roi), rentabilidad)
+
+
+_DASHBOARD_BUNDLE = _build_dashboard_bundle()
+
+
 class AnalyticsRepository:
     """Repositorio para análisis predictivo y métricas avanzadas."""
     
     def get_meta_mensual_progress(self, user_id, meta_objetivo=10000):
         """Calcula el progreso hacia la meta mensual."""
-        from datetime import date, timedelta
-        from dateutil.relativedelta import relativedelta
-        
         hoy = date.today()
         inicio_mes = hoy.replace(day=1)
         
         # Ganancia actual del mes
-        resultado = db.session.query(
-            func.sum(Tramite.precio - Tramite.costo).label('ganancia_actual')
-        ).join(Papeleria, Tramite.papeleria_id == Papeleria.id)\
-         .filter(
-            Tramite.user_id == user_id,
+        resultado = db.session.execute(select(
+            func.sum(TramiteMonthlyRollup.ingresos - TramiteMonthlyRollup.costos).label('ganancia_actual')
+        ).join(Papeleria, TramiteMonthlyRollup.papeleria_id == Papeleria.id)\
+         .where(
+            TramiteMonthlyRollup.user_id == user_id,
             Papeleria.is_active == True,
-            Tramite.fecha >= inicio_mes
-        ).first()
+            TramiteMonthlyRollup.month >= inicio_mes.strftime('%Y-%m')
+        )).first()
         
-        ganancia_actual = float(resultado.ganancia_actual or 0)
+        return self._meta_progress(float(resultado.ganancia_actual or 0), meta_objetivo, hoy)
+    
+    def _meta_progress(self, ganancia_actual, meta_objetivo, hoy):
+        """Arma el diccionario de progreso de la meta mensual a partir de la ganancia del mes."""
+        from dateutil.relativedelta import relativedelta
+
+        inicio_mes = hoy.replace(day=1)
         porcentaje = (ganancia_actual / meta_objetivo * 100) if meta_objetivo > 0 else 0
         
         # Calcular días restantes hasta el próximo DOMINGO (día de corte)
@@ -985,21 +1254,22 @@ class AnalyticsRepository:
     
     def get_mejor_mes_historico(self, user_id):
         """Obtiene el mejor mes histórico."""
-        resultado = db.session.query(
-            func.strftime('%Y-%m', Tramite.fecha).label('mes'),
-            func.sum(Tramite.precio - Tramite.costo).label('ganancia')
-        ).join(Papeleria, Tramite.papeleria_id == Papeleria.id)\
-         .filter(
-            Tramite.user_id == user_id,
+        resultado = db.session.execute(select(
+            TramiteMonthlyRollup.month.label('mes'),
+            func.sum(TramiteMonthlyRollup.ingresos - TramiteMonthlyRollup.costos).label('ganancia')
+        ).join(Papeleria, TramiteMonthlyRollup.papeleria_id == Papeleria.id)\
+         .where(
+            TramiteMonthlyRollup.user_id == user_id,
             Papeleria.is_active == True
         ).group_by('mes')\
          .order_by(db.desc('ganancia'))\
-         .first()
+         .limit(1)
+        ).first()
         
         if resultado:
             return {
                 'mes': resultado.mes,
-                'ganancia': float(resultado.ganancia)
+                'ganancia': resultado.ganancia
             }
         return None
     
@@ -1008,24 +1278,24 @@ class AnalyticsRepository:
         # SQLite: 0=Domingo, 1=Lunes, ..., 6=Sábado
         dias_nombres = ['Domingo', 'Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado']
         
-        resultado = db.session.query(
+        resultado = db.session.execute(select(
             func.strftime('%w', Tramite.fecha).label('dia_semana'),
-            func.sum(Tramite.precio - Tramite.costo).label('ganancia_total'),
+            func.sum(Tramite.ganancia).label('ganancia_total'),
             func.count(Tramite.id).label('cantidad_tramites')
         ).join(Papeleria, Tramite.papeleria_id == Papeleria.id)\
-         .filter(
+         .where(
             Tramite.user_id == user_id,
             Papeleria.is_active == True
         ).group_by('dia_semana')\
-         .order_by(db.desc('ganancia_total'))\
-         .all()
+         .order_by(db.desc('ganancia_total'))
+        ).all()
         
         if resultado:
             top_dia = resultado[0]
             dia_num = int(top_dia.dia_semana)
             return {
                 'dia_nombre': dias_nombres[dia_num],
-                'ganancia': float(top_dia.ganancia_total),
+                'ganancia': top_dia.ganancia_total,
                 'tramites': top_dia.cantidad_tramites
             }
         return None
@@ -1033,13 +1303,14 @@ class AnalyticsRepository:
     def get_hora_pico(self, user_id):
         """Calcula la hora pico de actividad (requiere timestamp, estimado)."""
         # Por simplicidad, retorna basado en trámites por día
-        resultado = db.session.query(
+        resultado = db.session.execute(select(
             func.strftime('%H', Tramite.fecha).label('hora'),
             func.count(Tramite.id).label('cantidad')
-        ).filter(Tramite.user_id == user_id)\
+        ).where(Tramite.user_id == user_id)\
          .group_by('hora')\
          .order_by(db.desc('cantidad'))\
-         .first()
+         .limit(1)
+        ).first()
         
         if resultado and resultado.hora:
             return f"{resultado.hora}:00"
@@ -1047,14 +1318,14 @@ class AnalyticsRepository:
     
     def get_margen_promedio(self, user_id):
         """Calcula el margen de ganancia promedio."""
-        resultado = db.session.query(
-            func.sum(Tramite.precio).label('total_ingresos'),
-            func.sum(Tramite.costo).label('total_costos')
-        ).join(Papeleria, Tramite.papeleria_id == Papeleria.id)\
-         .filter(
-            Tramite.user_id == user_id,
+        resultado = db.session.execute(select(
+            func.sum(TramiteMonthlyRollup.ingresos).label('total_ingresos'),
+            func.sum(TramiteMonthlyRollup.costos).label('total_costos')
+        ).join(Papeleria, TramiteMonthlyRollup.papeleria_id == Papeleria.id)\
+         .where(
+            TramiteMonthlyRollup.user_id == user_id,
             Papeleria.is_active == True
-        ).first()
+        )).first()
         
         if resultado and resultado.total_ingresos:
             ingresos = float(resultado.total_ingresos or 0)
@@ -1065,55 +1336,180 @@ class AnalyticsRepository:
     
     def get_costo_promedio_tramite(self, user_id):
         """Calcula el costo promedio por trámite."""
-        resultado = db.session.query(
-            func.avg(Tramite.costo).label('promedio')
-        ).filter(Tramite.user_id == user_id).first()
-        
-        return round(float(resultado.promedio or 0), 2)
+        promedio = func.sum(TramiteMonthlyRollup.costos) / func.sum(TramiteMonthlyRollup.count)
+        return db.session.execute(select(
+            func.round(func.coalesce(promedio, 0), 2)
+        ).where(TramiteMonthlyRollup.user_id == user_id)).scalar_one()
     
     def get_roi_por_papeleria(self, user_id):
         """Calcula ROI por papelería."""
-        resultado = db.session.query(
+        ingresos = func.sum(TramiteMonthlyRollup.ingresos)
+        costos = func.sum(TramiteMonthlyRollup.costos)
+        roi = (ingresos - costos) / costos * 100
+        resultado = db.session.execute(select(
             Papeleria.nombre,
-            func.sum(Tramite.precio).label('ingresos'),
-            func.sum(Tramite.costo).label('costos'),
-            ((func.sum(Tramite.precio) - func.sum(Tramite.costo)) / func.sum(Tramite.costo) * 100).label('roi')
-        ).join(Tramite, Papeleria.id == Tramite.papeleria_id)\
-         .filter(
+            ingresos.label('ingresos'),
+            costos.label('costos'),
+            func.round(roi, 1).label('roi')
+        ).join(TramiteMonthlyRollup, Papeleria.id == TramiteMonthlyRollup.papeleria_id)\
+         .where(
             Papeleria.user_id == user_id,
             Papeleria.is_active == True
         ).group_by(Papeleria.id, Papeleria.nombre)\
-         .having(func.sum(Tramite.costo) > 0)\
-         .order_by(db.desc('roi'))\
-         .limit(5)\
-         .all()
+         .having(costos > 0)\
+         .order_by(db.desc(roi))\
+         .limit(5)
+        ).all()
         
-        return [{'nombre': r.nombre, 'roi': round(float(r.roi), 1)} for r in resultado]
+        return [{'nombre': r.nombre, 'roi': r.roi} for r in resultado]
     
     def get_rentabilidad_por_tramite(self, user_id):
         """Analiza rentabilidad por tipo de trámite."""
-        resultado = db.session.query(
+        resultado = db.session.execute(select(
             Tramite.tramite,
             func.count(Tramite.id).label('cantidad'),
-            func.avg(Tramite.precio - Tramite.costo).label('margen_promedio'),
-            func.sum(Tramite.precio - Tramite.costo).label('ganancia_total')
+            func.round(func.coalesce(func.avg(Tramite.ganancia), 0), 2).label('margen_promedio'),
+            func.round(func.coalesce(func.sum(Tramite.ganancia), 0), 2).label('ganancia_total')
         ).join(Papeleria, Tramite.papeleria_id == Papeleria.id)\
-         .filter(
+         .where(
             Tramite.user_id == user_id,
             Papeleria.is_active == True
         ).group_by(Tramite.tramite)\
-         .order_by(db.desc('ganancia_total'))\
-         .all()
+         .order_by(db.desc('ganancia_total'))
+        ).all()
         
         return [{
             'tramite': r.tramite,
             'cantidad': r.cantidad,
-            'margen_promedio': round(float(r.margen_promedio or 0), 2),
-            'ganancia_total': round(float(r.ganancia_total or 0), 2)
+            'margen_promedio': r.margen_promedio,
+            'ganancia_total': r.ganancia_total
         } for r in resultado]
 
+    def get_dashboard_bundle(self, user_id, meta_objetivo=10000):
+        """
+        Obtiene en una sola consulta las métricas avanzadas del dashboard: meta mensual, mejor mes,
+        día más productivo, margen promedio, costo promedio, ROI por papelería y rentabilidad por trámite.
+
+        Las métricas por mes y por papelería salen del resumen mensual (tramite_monthly_rollup);
+        las que dependen del día o del tipo de trámite, de un CTE con los trámites del usuario.
+        Cada métrica es una rama de un UNION ALL con columnas genéricas (k, label, n, a, b) que se
+        reparten aquí en Python.
+        """
+        dias_nombres = ['Domingo', 'Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado']
+        hoy = date.today()
+        inicio_mes = hoy.replace(day=1)
+
+        filas = db.session.execute(
+            _DASHBOARD_BUNDLE, {'user_id': user_id, 'mes_actual': inicio_mes.strftime('%Y-%m')}
+        ).all()
+
+        por_clave = {}
+        for fila in filas:
+            por_clave.setdefault(fila.k, []).append(fila)
+
+        totales_fila = por_clave['totales'][0]
+        margen_fila = por_clave['margen'][0]
+        ingresos = float(margen_fila.a or 0)
+        costos = float(margen_fila.b or 0)
+
+        mejor_mes_dict = None
+        if 'mes' in por_clave:
+            fila = por_clave['mes'][0]
+            mejor_mes_dict = {'mes': fila.label, 'ganancia': fila.a}
+
+        dia_productivo = None
+        if 'dia' in por_clave:
+            fila = max(por_clave['dia'], key=lambda f: f.a)
+            dia_productivo = {
+                'dia_nombre': dias_nombres[int(fila.label)],
+                'ganancia': fila.a,
+                'tramites': fila.n
+            }
+
+        roi_papelerias = sorted(
+            ({'nombre': f.label, 'roi': f.a} for f in por_clave.get('roi', [])),
+            key=lambda r: r['roi'], reverse=True
+        )
+        rentabilidad_tramites = [{
+            'tramite': f.label,
+            'cantidad': f.n,
+            'margen_promedio': f.a,
+            'ganancia_total': f.b
+        } for f in sorted(por_clave.get('tramite', []), key=lambda f: f.b, reverse=True)]
+
+        return {
+            'meta_progress': self._meta_progress(float(totales_fila.a or 0), meta_objetivo, hoy),
+            'mejor_mes': mejor_mes_dict,
+            'dia_productivo': dia_productivo,
+            'margen_promedio': round((ingresos - costos) / ingresos * 100, 1) if ingresos > 0 else 0,
+            'costo_promedio_tramite': totales_fila.b,
+            'roi_papelerias': roi_papelerias,
+            'rentabilidad_tramites': rentabilidad_tramites
+        }
+
+
+class SearchRepository:
+    """Repository for the global search across tramites, papelerias and gastos."""
+
+    def search(self, user_id, q, limit=50):
+        """
+        Searches tramites (by name, papeleria or date), papelerias (by name) and gastos
+        (by description or proveedor) with LIKE filters, merged in a single UNION ALL query.
+        Results come grouped by type (tramites, papelerias, gastos), most recent first.
+
+        Returns the result's row mappings to be consumed once, as they are fetched.
+        """
+        def rama(orden, tipo, id_, titulo, detalle, fecha, monto, extra):
+            return [
+                literal(orden).label('orden'),
+                literal(tipo).label('tipo'),
+                id_.label('id'),
+                titulo.label('titulo'),
+                detalle.label('detalle'),
+                fecha.label('fecha'),
+                monto.label('monto'),
+                extra.label('extra'),
+            ]
+
+        tramites = select(*rama(
+            0, 'tramite', Tramite.id, Tramite.tramite, Papeleria.nombre,
+            Tramite.fecha, Tramite.ganancia, literal(None, Integer)
+        )).join(Papeleria, Tramite.papeleria_id == Papeleria.id)\
+         .where(
+            Tramite.user_id == user_id,
+            Papeleria.is_active == True,
+            Tramite.tramite.icontains(q, autoescape=True)
+            | Papeleria.nombre.icontains(q, autoescape=True)
+            | cast(Tramite.fecha, String).contains(q, autoescape=True)
+        ).order_by(Tramite.fecha.desc(), Tramite.id.desc()).limit(limit).subquery()
+
+        precios_count = select(func.count(PapeleriaPrecio.id))\
+            .where(PapeleriaPrecio.papeleria_id == Papeleria.id).scalar_subquery()
+        papelerias = select(*rama(
+            1, 'papeleria', Papeleria.id, Papeleria.nombre, literal(None, String),
+            literal(None, Date), literal(None, Float), precios_count
+        )).where(
+            Papeleria.user_id == user_id,
+            Papeleria.is_active == True,
+            Papeleria.nombre.icontains(q, autoescape=True)
+        ).order_by(Papeleria.nombre).limit(limit).subquery()
+
+        gastos = select(*rama(
+            2, 'gasto', Gasto.id, Gasto.descripcion, Proveedor.nombre,
+            Gasto.fecha, Gasto.monto, literal(None, Integer)
+        )).outerjoin(Proveedor, Gasto.proveedor_id == Proveedor.id)\
+         .where(
+            Gasto.user_id == user_id,
+            Gasto.descripcion.icontains(q, autoescape=True) | Proveedor.nombre.icontains(q, autoescape=True)
+        ).order_by(Gasto.fecha.desc(), Gasto.id.desc()).limit(limit).subquery()
+
+        merged = union_all(select(tramites), select(papelerias), select(gastos)).subquery()
+        stmt = select(merged).order_by(merged.c.orden, merged.c.fecha.desc(), merged.c.titulo).limit(limit)
+        return db.session.execute(stmt).mappings()
+
 
 proveedor_repository = ProveedorRepository()
 tramite_repository = TramiteRepository()
 gasto_repository = GastoRepository()
 analytics_repository = AnalyticsRepository()
+search_repository = SearchRepository()
@@ -3,7 +3,7 @@ SQLAlchemy models for DocuExpress.
 """
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import (Column, Integer, String, Float, ForeignKey, DateTime, Boolean,
-                        UniqueConstraint, Index, Date, func)
+                        UniqueConstraint, Index, Date, Computed, DDL, event, func, collate)
 from sqlalchemy.orm import relationship
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
@@ -42,6 +42,7 @@ class Papeleria(db.Model):
     __table_args__ = (
         UniqueConstraint('nombre', 'user_id', name='uq_papeleria_nombre_user'),
         Index('idx_papelerias_user', 'user_id'),
+        Index('idx_papelerias_user_activa_nombre', 'user_id', 'is_active', 'nombre'),
     )
 
 class PapeleriaPrecio(db.Model):
@@ -65,15 +66,63 @@ class Tramite(db.Model):
     precio = Column(Float, nullable=False)
     costo = Column(Float, nullable=False, default=0)
     timestamp = Column(DateTime, default=func.now())
+    # Mes 'YYYY-MM' calculado por SQLite; indexado para agrupar por mes sin strftime() por fila
+    mes = Column(String, Computed("strftime('%Y-%m', fecha)", persisted=False))
+    ganancia = Column(Float, Computed('precio - costo', persisted=False))
 
     user = relationship('User', back_populates='tramites')
     papeleria = relationship('Papeleria', back_populates='tramites')
 
     __table_args__ = (
         Index('idx_tramites_user_fecha', 'user_id', 'fecha'),
-        Index('idx_tramites_user_papeleria', 'user_id', 'papeleria_id'),
+        Index('idx_tramites_user_papeleria_fecha', 'user_id', 'papeleria_id', 'fecha'),
+        Index('idx_tramites_user_tramite', 'user_id', 'tramite'),
+        Index('idx_tramites_user_mes', 'user_id', 'mes'),
     )
 
+class TramiteMonthlyRollup(db.Model):
+    """Totales de trámites por usuario, papelería y mes; los mantienen los triggers de 'tramites'."""
+    __tablename__ = 'tramite_monthly_rollup'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    papeleria_id = Column(Integer, ForeignKey('papelerias.id', ondelete='CASCADE'), nullable=False)
+    month = Column(String, nullable=False)
+    ingresos = Column(Float, nullable=False, default=0)
+    costos = Column(Float, nullable=False, default=0)
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (UniqueConstraint('user_id', 'papeleria_id', 'month'), Index('idx_rollup_user_month', 'user_id', 'month'),)
+
+# Los triggers cubren también los INSERT/UPDATE/DELETE masivos (Core), que no disparan eventos del ORM.
+_ROLLUP_SUMAR = """
+    INSERT INTO tramite_monthly_rollup (user_id, papeleria_id, month, ingresos, costos, count)
+    VALUES (NEW.user_id, NEW.papeleria_id, strftime('%%Y-%%m', NEW.fecha), NEW.precio, NEW.costo, 1)
+    ON CONFLICT (user_id, papeleria_id, month) DO UPDATE SET
+        ingresos = ingresos + excluded.ingresos,
+        costos = costos + excluded.costos,
+        count = count + excluded.count;
+"""
+_ROLLUP_RESTAR = """
+    UPDATE tramite_monthly_rollup
+    SET ingresos = ingresos - OLD.precio, costos = costos - OLD.costo, count = count - 1
+    WHERE user_id = OLD.user_id AND papeleria_id = OLD.papeleria_id AND month = strftime('%%Y-%%m', OLD.fecha);
+    DELETE FROM tramite_monthly_rollup
+    WHERE user_id = OLD.user_id AND papeleria_id = OLD.papeleria_id AND month = strftime('%%Y-%%m', OLD.fecha) AND count <= 0;
+"""
+for _ddl in (
+    # Carga inicial para bases existentes: solo corre mientras el resumen está vacío
+    """INSERT INTO tramite_monthly_rollup (user_id, papeleria_id, month, ingresos, costos, count)
+       SELECT user_id, papeleria_id, strftime('%%Y-%%m', fecha), SUM(precio), SUM(costo), COUNT(*)
+       FROM tramites WHERE NOT EXISTS (SELECT 1 FROM tramite_monthly_rollup)
+       GROUP BY user_id, papeleria_id, strftime('%%Y-%%m', fecha)""",
+    f"CREATE TRIGGER IF NOT EXISTS trg_tramites_rollup_insert AFTER INSERT ON tramites BEGIN {_ROLLUP_SUMAR} END",
+    f"CREATE TRIGGER IF NOT EXISTS trg_tramites_rollup_delete AFTER DELETE ON tramites BEGIN {_ROLLUP_RESTAR} END",
+    "CREATE TRIGGER IF NOT EXISTS trg_tramites_rollup_update "
+    "AFTER UPDATE OF user_id, papeleria_id, fecha, precio, costo ON tramites "
+    f"BEGIN {_ROLLUP_RESTAR} {_ROLLUP_SUMAR} END",
+):
+    event.listen(db.metadata, 'after_create', DDL(_ddl).execute_if(dialect='sqlite'))
+
 class TramiteCosto(db.Model):
     __tablename__ = 'tramite_costos'
     id = Column(Integer, primary_key=True)
@@ -96,6 +145,10 @@ class Proveedor(db.Model):
 
     __table_args__ = (UniqueConstraint('user_id', 'nombre'), Index('idx_proveedores_user', 'user_id'),)
 
+# Nombres únicos por usuario sin distinguir mayúsculas; el índice también sirve el ORDER BY de la lista.
+# Es un índice (no la collation de la columna) para que run_db_migration lo cree en bases existentes.
+Index('uq_proveedores_user_nombre_nocase', Proveedor.user_id, collate(Proveedor.nombre, 'NOCASE'), unique=True)
+
 class Gasto(db.Model):
     __tablename__ = 'gastos'
     id = Column(Integer, primary_key=True)
@@ -106,8 +159,13 @@ class Gasto(db.Model):
     fecha = Column(Date, nullable=False)
     categoria = Column(String, nullable=False, default='OTROS')
     receipt_filename = Column(String)
+    mes = Column(String, Computed("strftime('%Y-%m', fecha)", persisted=False))
 
     user = relationship('User', back_populates='gastos')
     proveedor = relationship('Proveedor', back_populates='gastos')
 
-    __table_args__ = (Index('idx_gastos_user_fecha', 'user_id', 'fecha'),)
+    __table_args__ = (
+        Index('idx_gastos_user_fecha', 'user_id', 'fecha'),
+        Index('idx_gastos_user_mes', 'user_id', 'mes'),
+        Index('idx_gastos_user_categoria', 'user_id', 'categoria'),
+    )
@@ -2,34 +2,28 @@ from flask import Blueprint, jsonify, request
 from flask_login import login_required
 from flask import current_app
 
-from ..utils import get_effective_user_id, check_papeleria_owner
-from ..database import papeleria_repository, tramite_repository, gasto_repository, analytics_repository
+from ..utils import get_effective_user_id, check_papeleria_owner, cached_user_view, run_concurrently
+from ..database import papeleria_repository, tramite_repository, gasto_repository, analytics_repository, search_repository
 
 api_bp = Blueprint('api', __name__, url_prefix='/api')
 
 
-from flask_caching import Cache
-from flask import current_app
-
-
-def _get_cache_decorator(timeout=300):
-    """Devuelve un decorador cached si la extensión de caché está disponible.
-
-    Si no hay un objeto de caché con método `cached`, devuelve un decorador identidad
-    que deja la función sin cambios (fallback seguro en desarrollo).
-    """
-    cache_obj = getattr(current_app, 'cache', None) or current_app.extensions.get('cache')
-    if cache_obj and hasattr(cache_obj, 'cached'):
-        return cache_obj.cached(timeout=timeout)
-
-    def _identity(f):
-        return f
-
-    return _identity
+def _monthly_chart(summary_result):
+    """Transpone el resumen mensual (lista de filas) a las columnas que espera Chart.js, en una sola pasada."""
+    columnas = [(row['month'], row['ingresos'], row['gastos'], row['ganancias']) for row in summary_result['monthly_data']]
+    labels, ingresos, costos, ganancias = (list(c) for c in zip(*columnas)) if columnas else ([], [], [], [])
+    return {
+        'labels': labels,
+        'ingresos': ingresos,
+        'costos': costos,
+        'ganancias': ganancias,
+        'totals': summary_result['totals']
+    }
 
 
 @api_bp.route('/dashboard-charts')
 @login_required
+@cached_user_view(timeout=60)
 def dashboard_charts_data():
     """Endpoint para obtener datos de gráficos del dashboard."""
     effective_user_id = get_effective_user_id()
@@ -38,45 +32,32 @@ def dashboard_charts_data():
     fecha_inicio = request.args.get('fecha_inicio')
     fecha_fin = request.args.get('fecha_fin')
     
-    # 1. Top Papelerías
-    top_papelerias = papeleria_repository.get_top_by_ganancia(
-        effective_user_id, 
-        limit=10,
-        fecha_inicio=fecha_inicio,
-        fecha_fin=fecha_fin
+    # Las cuatro consultas son independientes: se ejecutan en paralelo
+    top_papelerias, summary_result, dist_data, gastos_data = run_concurrently(
+        lambda: papeleria_repository.get_top_by_ganancia(
+            effective_user_id, limit=10, fecha_inicio=fecha_inicio, fecha_fin=fecha_fin
+        ),
+        lambda: tramite_repository.get_monthly_summary(
+            effective_user_id, fecha_inicio=fecha_inicio, fecha_fin=fecha_fin
+        ),
+        lambda: tramite_repository.get_tramites_distribution(
+            effective_user_id, fecha_inicio=fecha_inicio, fecha_fin=fecha_fin
+        ),
+        lambda: gasto_repository.get_gastos_distribution(
+            effective_user_id, fecha_inicio=fecha_inicio, fecha_fin=fecha_fin
+        ),
     )
+
+    # 1. Top Papelerías
     top_papelerias_data = {'labels': [p['nombre'] for p in top_papelerias], 'data': [p['ganancia_total'] or 0 for p in top_papelerias]}
 
     # 2. Resumen Mensual
-    summary_result = tramite_repository.get_monthly_summary(
-        effective_user_id,
-        fecha_inicio=fecha_inicio,
-        fecha_fin=fecha_fin
-    )
-    monthly_summary_data = summary_result['monthly_data']
-    
-    monthly_summary = {
-        'labels': [row['month'] for row in monthly_summary_data],
-        'ingresos': [row['ingresos'] for row in monthly_summary_data],
-        'costos': [row['gastos'] for row in monthly_summary_data],
-        'ganancias': [row['ganancias'] for row in monthly_summary_data],
-        'totals': summary_result['totals']
-    }
+    monthly_summary = _monthly_chart(summary_result)
 
     # 3. Distribución de Trámites
-    dist_data = tramite_repository.get_tramites_distribution(
-        effective_user_id,
-        fecha_inicio=fecha_inicio,
-        fecha_fin=fecha_fin
-    )
     tramites_dist = {'labels': [row['tramite_label'] for row in dist_data], 'data': [row['total_count'] for row in dist_data]}
 
     # 4. Distribución de Gastos
-    gastos_data = gasto_repository.get_gastos_distribution(
-        effective_user_id,
-        fecha_inicio=fecha_inicio,
-        fecha_fin=fecha_fin
-    )
     gastos_dist = {'labels': [row['categoria'] for row in gastos_data], 'data': [row['total_monto'] for row in gastos_data]}
 
     return jsonify({
@@ -119,6 +100,7 @@ def test_charts_data():
 @api_bp.route('/papeleria-charts/<int:papeleria_id>')
 @login_required
 @check_papeleria_owner
+@cached_user_view(timeout=60)
 def papeleria_charts_data(papeleria_id):
     """Endpoint único para los gráficos de la página de detalle de papelería."""
     effective_user_id = get_effective_user_id()
@@ -127,15 +109,7 @@ def papeleria_charts_data(papeleria_id):
     tramites_dist = {'labels': [row['tramite_label'] for row in dist_data], 'data': [row['total_count'] for row in dist_data]}
     # 2. Resumen mensual para esta papelería
     summary_result = tramite_repository.get_monthly_summary_for_papeleria(papeleria_id, effective_user_id)
-    monthly_summary_data = summary_result['monthly_data']
-    
-    monthly_summary = {
-        'labels': [row['month'] for row in monthly_summary_data],
-        'ingresos': [row['ingresos'] for row in monthly_summary_data],
-        'costos': [row['gastos'] for row in monthly_summary_data],
-        'ganancias': [row['ganancias'] for row in monthly_summary_data],
-        'totals': summary_result['totals']
-    }
+    monthly_summary = _monthly_chart(summary_result)
     
     return jsonify({'tramitesDistribution': tramites_dist, 'monthlySummary': monthly_summary})
 
@@ -177,80 +151,55 @@ def get_precio_costo(papeleria_id, tramite_nombre):
 
 @api_bp.route('/analytics-avanzado')
 @login_required
+@cached_user_view(timeout=60)
 def analytics_avanzado():
     """Endpoint para obtener análisis avanzados y métricas predictivas."""
     effective_user_id = get_effective_user_id()
     
-    return jsonify({
-        'meta_progress': analytics_repository.get_meta_mensual_progress(effective_user_id),
-        'mejor_mes': analytics_repository.get_mejor_mes_historico(effective_user_id),
-        'dia_productivo': analytics_repository.get_dias_mas_productivos(effective_user_id),
-        'margen_promedio': analytics_repository.get_margen_promedio(effective_user_id),
-        'costo_promedio_tramite': analytics_repository.get_costo_promedio_tramite(effective_user_id),
-        'roi_papelerias': analytics_repository.get_roi_por_papeleria(effective_user_id),
-        'rentabilidad_tramites': analytics_repository.get_rentabilidad_por_tramite(effective_user_id)
-    })
+    return jsonify(analytics_repository.get_dashboard_bundle(effective_user_id))
 
 @api_bp.route('/buscar')
 @login_required
 def buscar():
     """Búsqueda global en trámites, papelerías, gastos y proveedores."""
     # Rate limiting desactivado para búsqueda
+    from flask import url_for
     
-    from database import tramite_repository, papeleria_repository, gasto_repository
-    from flask import request, url_for
-    
-    query = request.args.get('q', '').lower().strip()
+    query = request.args.get('q', '').strip()
     effective_user_id = get_effective_user_id()
     
     if not query or len(query) < 2:
         return jsonify([])
     
+    # El filtrado (LIKE) y el límite de 50 resultados se resuelven en SQL, en una sola consulta;
+    # las filas se leen directamente del cursor, sin copias intermedias
     results = []
-    
-    # Buscar en trámites (últimos 100)
-    tramites = tramite_repository.get_all_tramites(effective_user_id, limit=100)
-    for tramite in tramites:
-        # Buscar en nombre del trámite, papelería o fecha
-        if (query in tramite['tramite'].lower() or 
-            query in tramite['papeleria'].lower() or
-            query in str(tramite['fecha'])):
+    for row in search_repository.search(effective_user_id, query, limit=50):
+        if row['tipo'] == 'tramite':
             results.append({
                 'type': 'tramite',
                 'type_label': 'Trámite',
-                'title': tramite['tramite'],
-                'subtitle': f"{tramite['papeleria']} - {tramite['fecha']} - ${tramite['ganancia']:.2f}",
+                'title': row['titulo'],
+                'subtitle': f"{row['detalle']} - {row['fecha']} - ${float(row['monto']):.2f}",
                 'url': url_for('main.index', _anchor='tramites')
             })
-    
-    # Buscar en papelerías
-    papelerias = papeleria_repository.get_all_papelerias(effective_user_id)
-    for papeleria in papelerias:
-        if query in papeleria['nombre'].lower():
+        elif row['tipo'] == 'papeleria':
             results.append({
                 'type': 'papeleria',
                 'type_label': 'Papelería',
-                'title': papeleria['nombre'],
-                'subtitle': f"Precios configurados: {len(papeleria.get('precios', []))}",
-                'url': url_for('papeleria.ver_papeleria', id=papeleria['id'])
+                'title': row['titulo'],
+                'subtitle': f"Precios configurados: {row['extra']}",
+                'url': url_for('papeleria.ver_papeleria', papeleria_id=row['id'])
             })
-    
-    # Buscar en gastos (últimos 100)
-    gastos = gasto_repository.get_all_gastos(effective_user_id, limit=100)
-    for gasto in gastos:
-        if (query in gasto['concepto'].lower() or 
-            (gasto.get('proveedor') and query in gasto['proveedor'].lower())):
+        else:
             results.append({
                 'type': 'gasto',
                 'type_label': 'Gasto',
-                'title': gasto['concepto'],
-                'subtitle': f"${gasto['monto']:.2f} - {gasto['fecha']} - {gasto.get('proveedor', 'Sin proveedor')}",
-                'url': url_for('gastos.index', _anchor='gastos')
+                'title': row['titulo'],
+                'subtitle': f"${float(row['monto']):.2f} - {row['fecha']} - {row['detalle'] or 'Sin proveedor'}",
+                'url': url_for('gastos.gestion_gastos', _anchor='gastos')
             })
     
-    # Limitar resultados a 50
-    results = results[:50]
-    
     return jsonify(results)
 
 @api_bp.route('/notificaciones')
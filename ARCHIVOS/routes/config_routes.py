@@ -2,10 +2,10 @@ from flask import Blueprint, render_template, redirect, url_for, flash, request,
 from flask_login import login_required, current_user
 import os
 
-from ..utils import get_effective_user_id, admin_required, save_logo_image
+from ..utils import get_effective_user_id, admin_required, save_logo_image, bump_all_data_versions
 from ..forms import ConfigForm
 from ..database import tramite_repository
-from ..constants import TRAMITES_PREDEFINIDOS
+from ..constants import TRAMITES_PREDEFINIDOS_SET
 from ..backup_manager import backup_manager
 
 config_bp = Blueprint('config', __name__, url_prefix='/configuracion')
@@ -13,7 +13,7 @@ config_bp = Blueprint('config', __name__, url_prefix='/configuracion')
 def _get_all_tramites(user_id):
     """Función auxiliar para obtener una lista única y ordenada de todos los trámites."""
     tramites_usuario = tramite_repository.get_distinct_tramites(user_id)
-    todos_los_tramites = sorted(list(set(TRAMITES_PREDEFINIDOS + tramites_usuario)))
+    todos_los_tramites = sorted(TRAMITES_PREDEFINIDOS_SET.union(tramites_usuario))
     return todos_los_tramites
 
 @config_bp.route('/', methods=['GET'])
@@ -175,6 +175,8 @@ def restore_backup(filename):
     success = backup_manager.restore_backup(filename)
     
     if success:
+        # La restauración reemplaza los datos de todos los usuarios, no solo los del admin
+        bump_all_data_versions()
         flash('Base de datos restaurada exitosamente. Por favor, reinicia la aplicación.', 'success')
         return jsonify({
             'success': True,
@@ -6,7 +6,7 @@ import logging
 from werkzeug.utils import secure_filename
 
 from ..forms import GastoForm, EditarGastoForm, ProveedorForm, EditarProveedorForm, CATEGORIAS_GASTOS, DeleteForm
-from ..utils import get_effective_user_id
+from ..utils import get_effective_user_id, cached_user_value
 from ..database import gasto_repository, proveedor_repository
 
 gastos_bp = Blueprint('gastos', __name__)
@@ -72,8 +72,14 @@ def gestion_gastos():
     page = request.args.get('page', 1, type=int)
     per_page = 15
 
-    gastos, total_items = gasto_repository.get_all(
-        effective_user_id, page, per_page, fecha_inicio, fecha_fin, categoria_filtro
+    # El total (COUNT) se cachea por usuario y filtros; al cambiar de página solo se consulta la página
+    total_items = cached_user_value(
+        'gastos_total',
+        lambda: gasto_repository.count_all(effective_user_id, fecha_inicio, fecha_fin, categoria_filtro),
+        fecha_inicio, fecha_fin, categoria_filtro
+    )
+    gastos, _ = gasto_repository.get_all(
+        effective_user_id, page, per_page, fecha_inicio, fecha_fin, categoria_filtro, count=False
     )
     total_pages = (total_items + per_page - 1) // per_page if total_items > 0 else 1
 
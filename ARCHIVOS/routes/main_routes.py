@@ -1,4 +1,4 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file, session
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, Response, stream_with_context
 from flask_login import login_required
 from datetime import datetime
 import io
@@ -25,12 +25,8 @@ def _get_dashboard_context(search_term=None):
     totales_comparativa = papeleria_repository.get_totales_comparativa(effective_user_id)
     tramites_comparativa = tramite_repository.get_tramites_comparativa(effective_user_id)
     
-    # Obtener analytics avanzados
-    meta_progress = analytics_repository.get_meta_mensual_progress(effective_user_id)
-    mejor_mes = analytics_repository.get_mejor_mes_historico(effective_user_id)
-    dia_productivo = analytics_repository.get_dias_mas_productivos(effective_user_id)
-    margen_promedio = analytics_repository.get_margen_promedio(effective_user_id)
-    rentabilidad_tramites = analytics_repository.get_rentabilidad_por_tramite(effective_user_id)
+    # Obtener analytics avanzados (una sola consulta)
+    analytics = analytics_repository.get_dashboard_bundle(effective_user_id)
     
     tramites_hoy = tramites_comparativa['hoy']
     total_gastos = gasto_repository.get_total_gastos(effective_user_id)
@@ -41,11 +37,11 @@ def _get_dashboard_context(search_term=None):
         'totales_comparativa': totales_comparativa,
         'tramites_de_hoy': tramites_hoy,
         'tramites_comparativa': tramites_comparativa,
-        'meta_progress': meta_progress,
-        'mejor_mes': mejor_mes,
-        'dia_productivo': dia_productivo,
-        'margen_promedio': margen_promedio,
-        'rentabilidad_tramites': rentabilidad_tramites[:5],  # Top 5
+        'meta_progress': analytics['meta_progress'],
+        'mejor_mes': analytics['mejor_mes'],
+        'dia_productivo': analytics['dia_productivo'],
+        'margen_promedio': analytics['margen_promedio'],
+        'rentabilidad_tramites': analytics['rentabilidad_tramites'][:5],  # Top 5
         'num_papelerias': len(papelerias),
         'total_gastos_operativos': total_gastos,
         'search_term': search_term,
@@ -102,20 +98,24 @@ def exportar_csv_general():
     """Exporta todos los trámites del usuario a un archivo CSV."""
     effective_user_id = get_effective_user_id()
     data = tramite_repository.export_all_as_csv(effective_user_id)
-    
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['Papelería', 'Trámite', 'Fecha', 'Precio', 'Costo', 'Ganancia'])
-    for row in data:
-        writer.writerow([row.papeleria, row.tramite, row.fecha.strftime('%Y-%m-%d'), row.precio, row.costo, row.ganancia])
 
-    output.seek(0)
-    
-    return send_file(
-        io.BytesIO(output.read().encode('utf-8')),
+    def generar_csv():
+        # Se escribe fila por fila sobre un buffer reutilizable para no acumular todo el archivo en memoria
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(['Papelería', 'Trámite', 'Fecha', 'Precio', 'Costo', 'Ganancia'])
+        for row in data:
+            writer.writerow([row.papeleria, row.tramite, row.fecha.strftime('%Y-%m-%d'), row.precio, row.costo, row.ganancia])
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate(0)
+        if output.tell():
+            yield output.getvalue()
+
+    return Response(
+        stream_with_context(generar_csv()),
         mimetype='text/csv',
-        as_attachment=True,
-        download_name=f"reporte_general_{datetime.now().strftime('%Y-%m-%d')}.csv"
+        headers={'Content-Disposition': f"attachment; filename=reporte_general_{datetime.now().strftime('%Y-%m-%d')}.csv"}
     )
 
 @main_bp.route('/dismiss-notification', methods=['POST'])
@@ -10,7 +10,7 @@ import logging
 from ..forms import PapeleriaForm, TramiteForm, EditarTramiteForm, EditarPapeleriaForm, DeleteForm
 from ..utils import get_effective_user_id, check_papeleria_owner, admin_required
 from ..database import papeleria_repository, tramite_repository, gasto_repository
-from ..constants import TRAMITES_PREDEFINIDOS
+from ..constants import TRAMITES_PREDEFINIDOS_SET
 from ..pdf_generator import generar_pdf_papeleria
 
 papeleria_bp = Blueprint('papeleria', __name__)
@@ -222,7 +222,7 @@ def editar_tramite(tramite_id):
 
     form = EditarTramiteForm(obj=tramite)
     
-    if tramite.tramite not in TRAMITES_PREDEFINIDOS:
+    if tramite.tramite not in TRAMITES_PREDEFINIDOS_SET:
         form.tramite.data = 'OTRO'
         form.tramite_manual.data = tramite.tramite
 
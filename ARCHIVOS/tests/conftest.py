@@ -1,11 +1,21 @@
 import pytest
 import os
+from contextlib import contextmanager
+from cachelib import SimpleCache
+from flask_session import Session as ServerSideSession
+from flask_sqlalchemy.session import Session
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import event
 from ARCHIVOS.app import create_app
-from ARCHIVOS.models import db, User, Papeleria, Tramite, Gasto
+from ARCHIVOS.models import db, User, Papeleria, Proveedor
+
+# Set by pytest-xdist ('gw0', 'gw1', ...) when the suite runs with -n; absent in serial runs
+_WORKER = os.environ.get('PYTEST_XDIST_WORKER', 'main')
 
 class TestConfig:
     """Test configuration."""
     TESTING = True
+    # Every xdist worker is its own process, so each one gets a private in-memory database
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     WTF_CSRF_ENABLED = False
     SECRET_KEY = 'test-secret-key'
@@ -13,9 +23,15 @@ class TestConfig:
     # As the tests are in a subdirectory, the root path might need adjustment.
     BASE_DIR = os.path.abspath(os.path.dirname(__file__))
     # Provide a DATABASE_PATH so backup_manager can initialize without errors
-    DATABASE_PATH = os.path.join(BASE_DIR, 'test_database.sqlite')
+    DATABASE_PATH = os.path.join(BASE_DIR, f'test_database_{_WORKER}.sqlite')
     # Disable rate limiting during tests to avoid Redis dependency
     RATELIMIT_ENABLED = False
+    # Server-side sessions in an in-process dict: the test client's cookie is just an opaque
+    # session id, so requests skip signing and verifying the session payload
+    SESSION_TYPE = 'cachelib'
+    SESSION_CACHELIB = SimpleCache()
+    # Transactions are begun explicitly (see the 'begin' listener in the app fixture)
+    SQLALCHEMY_ENGINE_OPTIONS = {'connect_args': {'isolation_level': None}}
     # You might not need this if your app structure handles it, but it's a common pattern.
     # For instance, if your create_app uses instance_relative_config.
 
@@ -24,20 +40,102 @@ class TestConfig:
         """Initialize test app - minimal setup for tests."""
         pass
 
-@pytest.fixture(scope='module')
-def app():
-    """Create and configure a new app instance for each test module."""
-    app = create_app(config_class=TestConfig)
+class _TransactionalSession(Session):
+    """Session that honours an explicit ``bind`` (the per-test connection) before the app's engines."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.bind is not None:
+            return self.bind
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+SEED_PAPELERIA_ID = 1
+SEED_PROVEEDOR_ID = 1
+
+
+def _seed_database():
+    """Users, papeleria and proveedor every test starts from; committed once per test session."""
+    user = User(id=1, username='testuser', role='employee')
+    user.set_password('password')
+    admin = User(id=2, username='admin', role='admin')
+    admin.set_password('password')
+    db.session.add_all([
+        user, admin,
+        Papeleria(id=SEED_PAPELERIA_ID, nombre='Test Papeleria', user_id=user.id),
+        Proveedor(id=SEED_PROVEEDOR_ID, nombre='Proveedor Seed', user_id=user.id),
+    ])
+    db.session.commit()
+
+
+@contextmanager
+def _count_queries(conn=None):
+    """Collect the SQL statements executed on ``conn`` (the test's connection by default)."""
+    conn = conn if conn is not None else db.session.connection()
+    queries = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        queries.append(statement)
+
+    event.listen(conn, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield queries
+    finally:
+        event.remove(conn, 'before_cursor_execute', before_cursor_execute)
+
+
+@contextmanager
+def _make_app(config_class, request, tmp_path_factory):
+    """Build a test app on ``config_class`` with its in-memory schema and seed data."""
+    app = create_app(config_class=config_class)
+    ServerSideSession(app)
+    # Compiled templates already stay in memory for the session; the bytecode cache (keyed by
+    # source checksum) lets later test runs skip compiling them. It lives in this project's
+    # .pytest_cache; with the cache plugin disabled it falls back to this run's temp directory.
+    cache = getattr(request.config, 'cache', None)
+    bytecode_dir = cache.mkdir('jinja-bytecode') if cache else tmp_path_factory.mktemp('jinja-bytecode')
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(str(bytecode_dir))
     with app.app_context():
+        # The in-memory database lives on the pool's single connection (already opened by
+        # create_app, so a 'connect' listener would not fire): set the pragmas on it directly.
+        # Its journal is already in memory; nothing on disk needs syncing.
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql('PRAGMA synchronous=OFF')
+            conn.exec_driver_sql('PRAGMA temp_store=MEMORY')
+        # pysqlite only opens transactions lazily, which breaks SAVEPOINT; emit BEGIN ourselves
+        # (the connection runs with isolation_level=None, see TestConfig)
+        event.listen(db.engine, 'begin', lambda conn: conn.exec_driver_sql('BEGIN'))
+        db.session.session_factory.class_ = _TransactionalSession
         db.create_all()
-        yield app
+        _seed_database()
+    yield app
+    with app.app_context():
         db.drop_all()
 
+
+@pytest.fixture(scope='session')
+def app(request, tmp_path_factory):
+    """Create the app and its in-memory schema once for the whole test session.
+
+    A test module that needs other settings overrides this fixture with its own (module-scoped)
+    ``app`` built by ``_make_app``; the client and database fixtures below follow the override.
+    """
+    with _make_app(TestConfig, request, tmp_path_factory) as app:
+        yield app
+
 @pytest.fixture(scope='module')
 def client(app):
     """A test client for the app."""
     return app.test_client()
 
+@pytest.fixture(scope='module')
+def logged_client(app):
+    """A test client already logged in as the seeded user (id=1)."""
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['_user_id'] = '1'
+        sess['_fresh'] = True
+    return client
+
 @pytest.fixture(scope='function')
 def runner(app):
     """A test runner for the app's Click commands."""
@@ -45,30 +143,40 @@ def runner(app):
 
 @pytest.fixture(scope='function')
 def init_database(app):
-    """Seed the database with some test data."""
+    """
+    Run the test inside a transaction that is rolled back afterwards, so every test sees
+    only the seed data. Repository commits just release a SAVEPOINT of that transaction.
+    The test body runs inside this fixture's app context, so tests need not push their own.
+    Commits do not expire loaded objects: nothing else writes to this connection, and the
+    rollback discards the whole state anyway, so reading attributes after a commit needs no SELECT.
+    """
     with app.app_context():
-        # Clean up all tables before seeding
-        db.session.query(Gasto).delete()
-        db.session.query(Tramite).delete()
-        db.session.query(Papeleria).delete()
-        db.session.query(User).delete()
-        db.session.commit()
-
-        # Seed users
-        user = User(id=1, username='testuser', role='employee')
-        user.set_password('password')
-        admin = User(id=2, username='admin', role='admin')
-        admin.set_password('password')
-        db.session.add(user)
-        db.session.add(admin)
-        db.session.commit()
-
-        # Seed papeleria for the test user
-        papeleria = Papeleria(id=1, nombre='Test Papeleria', user_id=user.id)
-        db.session.add(papeleria)
-        db.session.commit()
-        
+        connection = db.engine.connect()
+        transaction = connection.begin()
+        db.session.remove()
+        session_defaults = dict(db.session.session_factory.kw)
+        db.session.configure(bind=connection, join_transaction_mode='create_savepoint', expire_on_commit=False)
+
         yield db
 
-        # Clean up after the test function
         db.session.remove()
+        # configure() cannot unset join_transaction_mode, so restore the factory's options wholesale
+        db.session.session_factory.kw.clear()
+        db.session.session_factory.kw.update(session_defaults)
+        transaction.rollback()
+        connection.close()
+
+@pytest.fixture
+def papeleria_id(init_database):
+    """ID of the seeded papeleria (user 1); tests use it instead of creating their own."""
+    return SEED_PAPELERIA_ID
+
+@pytest.fixture
+def proveedor_id(init_database):
+    """ID of the seeded proveedor (user 1); tests use it instead of creating their own."""
+    return SEED_PROVEEDOR_ID
+
+@pytest.fixture
+def count_queries(init_database):
+    """``with count_queries() as queries:`` records the statements run inside the block."""
+    return _count_queries
@@ -1,5 +1,19 @@
 import pytest
+from datetime import date, timedelta
 from app import create_app
+from ARCHIVOS.tests.conftest import TestConfig, _make_app
+
+
+class CacheTestConfig(TestConfig):
+    # La NullCache de los tests no guarda versión de datos y sin ella no se envía ETag
+    CACHE_TYPE = 'SimpleCache'
+
+
+@pytest.fixture(scope='module')
+def app(request, tmp_path_factory):
+    """App de este módulo con SimpleCache; logged_client e init_database la usan en lugar de la de sesión."""
+    with _make_app(CacheTestConfig, request, tmp_path_factory) as app:
+        yield app
 
 @pytest.fixture
 def client():
@@ -13,3 +27,52 @@ def test_dashboard_charts_requires_login(client):
     # Debe redirigir al login si no está autenticado
     assert response.status_code in (302, 401)
     assert b'inicia sesi' in response.data or b'login' in response.data
+
+def test_dashboard_charts_etag_304(logged_client, init_database):
+    first = logged_client.get('/api/dashboard-charts')
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+
+    # Sin cambios: el navegador recibe 304 sin cuerpo
+    again = logged_client.get('/api/dashboard-charts', headers={'If-None-Match': etag})
+    assert again.status_code == 304
+    assert again.data == b''
+
+    # Una escritura del usuario cambia la versión de datos y con ella el ETag
+    logged_client.post('/proveedores', data={'nombre': 'Proveedor ETag'})
+    changed = logged_client.get('/api/dashboard-charts', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+
+def test_dashboard_charts_etag_cambia_con_el_dia(logged_client, init_database, monkeypatch):
+    etag = logged_client.get('/api/dashboard-charts').headers['ETag']
+
+    # El rango por defecto (últimos 12 meses) depende de la fecha: otro día, otra respuesta
+    class Manana(date):
+        @classmethod
+        def today(cls):
+            return date.today() + timedelta(days=1)
+
+    monkeypatch.setattr('ARCHIVOS.utils.date', Manana)
+    changed = logged_client.get('/api/dashboard-charts', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+
+def test_restaurar_backup_invalida_a_todos_los_usuarios(app, logged_client, init_database, monkeypatch):
+    from ARCHIVOS.backup_manager import backup_manager
+
+    etag = logged_client.get('/api/dashboard-charts').headers['ETag']
+
+    # Un admin (otro usuario) restaura un backup: los datos del usuario 1 también cambian
+    monkeypatch.setattr(backup_manager, 'restore_backup', lambda filename: True)
+    admin_client = app.test_client()
+    with admin_client.session_transaction() as sess:
+        sess['_user_id'] = '2'
+        sess['_fresh'] = True
+    # Contexto propio: Flask-Login guarda el usuario en g, y el contexto de init_database ya tiene al usuario 1
+    with app.app_context():
+        assert admin_client.post('/configuracion/backups/restore/backup.db').status_code == 200
+
+    changed = logged_client.get('/api/dashboard-charts', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
@@ -3,20 +3,17 @@ Tests para el módulo de trámites.
 """
 import pytest
 from datetime import date, timedelta
-from ARCHIVOS.models import db, User, Papeleria, Tramite, TramiteCosto
+from sqlalchemy import select
+from ARCHIVOS.models import db, User, Papeleria, Tramite, TramiteCosto, TramiteMonthlyRollup
 
 
 class TestTramitesRoutes:
     """Tests para las rutas de trámites."""
     
-    def test_registrar_tramite(self, client, app, init_database):
+    def test_registrar_tramite(self, logged_client, app, init_database):
         """Test registrar un nuevo trámite."""
-        with client.session_transaction() as sess:
-            sess['_user_id'] = '1'
-            sess['_fresh'] = True
-        
         # La ruta es /registrar-tramite (POST) no /papeleria/1/registrar-tramite
-        response = client.post('/registrar-tramite', data={
+        response = logged_client.post('/registrar-tramite', data={
             'papeleria_id': 1,
             'tramite': 'ACTA DE NACIMIENTO',
             'precio': '50.00',
@@ -28,14 +25,37 @@ class TestTramitesRoutes:
         # Puede redirigir o devolver 200
         assert response.status_code in [200, 302]
     
-    def test_ver_detalle_papeleria(self, client, app, init_database):
+    def test_ver_detalle_papeleria(self, logged_client, app, init_database):
         """Test ver detalle de una papelería con trámites."""
+        response = logged_client.get('/papeleria/1')
+        assert response.status_code == 200
+    
+    def test_exportar_csv_general(self, client, app, init_database):
+        """Test exportar todos los trámites del usuario como CSV."""
+        from ARCHIVOS.database import tramite_repository
+        db.session.add(Papeleria(id=2, nombre='Admin Papeleria', user_id=2))
+        db.session.commit()
+        tramite_repository.add_bulk(
+            papeleria_id=2,
+            tramite='ACTA DE NACIMIENTO',
+            user_id=2,
+            fecha=date.today(),
+            precio=50.00,
+            costo=20.00,
+            cantidad=3
+        )
+    
         with client.session_transaction() as sess:
-            sess['_user_id'] = '1'
+            sess['_user_id'] = '2'
             sess['_fresh'] = True
         
-        response = client.get('/papeleria/1')
+        response = client.get('/exportar-csv/general')
         assert response.status_code == 200
+        assert response.mimetype == 'text/csv'
+        lineas = response.get_data(as_text=True).splitlines()
+        assert lineas[0] == 'Papelería,Trámite,Fecha,Precio,Costo,Ganancia'
+        assert len(lineas) == 4
+        assert lineas[1].startswith('Admin Papeleria,ACTA DE NACIMIENTO')
 
 
 class TestTramiteRepository:
@@ -43,113 +63,235 @@ class TestTramiteRepository:
     
     def test_crear_tramite_bulk(self, app, init_database):
         """Test crear trámites en la base de datos."""
-        with app.app_context():
-            from ARCHIVOS.database import tramite_repository
-            
-            tramite_repository.add_bulk(
-                papeleria_id=1,
-                tramite='ACTA DE MATRIMONIO',
-                user_id=1,
-                fecha=date.today().strftime('%Y-%m-%d'),
-                precio=80.00,
-                costo=40.00,
-                cantidad=1
-            )
-            
-            tramite = Tramite.query.filter_by(tramite='ACTA DE MATRIMONIO').first()
-            assert tramite is not None
-            assert tramite.precio == 80.00
+        from ARCHIVOS.database import tramite_repository
+        
+        tramite_repository.add_bulk(
+            papeleria_id=1,
+            tramite='ACTA DE MATRIMONIO',
+            user_id=1,
+            fecha=date.today(),
+            precio=80.00,
+            costo=40.00,
+            cantidad=1
+        )
+        
+        tramite = db.session.execute(select(Tramite).where(Tramite.tramite == 'ACTA DE MATRIMONIO')).scalar_one()
+        assert tramite.precio == 80.00
     
-    def test_crear_multiples_tramites_bulk(self, app, init_database):
+    def test_crear_multiples_tramites_bulk(self, app, init_database, count_queries):
         """Test crear múltiples trámites de un solo tipo."""
-        with app.app_context():
-            from ARCHIVOS.database import tramite_repository
-            
+        from ARCHIVOS.database import tramite_repository
+        
+        with count_queries() as queries:
             tramite_repository.add_bulk(
                 papeleria_id=1,
                 tramite='CONSTANCIA BULK',
                 user_id=1,
-                fecha=date.today().strftime('%Y-%m-%d'),
+                fecha=date.today(),
                 precio=25.00,
                 costo=10.00,
                 cantidad=3
             )
-            
-            tramites = Tramite.query.filter_by(tramite='CONSTANCIA BULK', user_id=1).all()
-            assert len(tramites) == 3
+        # Un solo INSERT (executemany) para todas las filas, sin objetos del ORM
+        assert len([q for q in queries if 'SAVEPOINT' not in q]) == 1
+        assert not db.session.identity_map
+        
+        tramites = db.session.execute(
+            select(Tramite).where(Tramite.tramite == 'CONSTANCIA BULK', Tramite.user_id == 1)
+        ).scalars().all()
+        assert len(tramites) == 3
     
-    def test_resumen_mensual(self, app, init_database):
+    def test_resumen_mensual(self, app, init_database, count_queries):
         """Test obtener resumen mensual de trámites."""
-        with app.app_context():
-            from ARCHIVOS.database import tramite_repository
-            
-            # Crear algunos trámites
-            tramite_repository.add_bulk(
-                papeleria_id=1,
-                tramite='RESUMEN 1',
-                user_id=1,
-                fecha=date.today().strftime('%Y-%m-%d'),
-                precio=100.00,
-                costo=50.00,
-                cantidad=1
-            )
-            
+        from ARCHIVOS.database import tramite_repository
+        
+        # Crear algunos trámites
+        tramite_repository.add_bulk(
+            papeleria_id=1,
+            tramite='RESUMEN 1',
+            user_id=1,
+            fecha=date.today(),
+            precio=100.00,
+            costo=50.00,
+            cantidad=1
+        )
+        
+        with count_queries() as queries:
             summary = tramite_repository.get_monthly_summary(1)
-            
-            assert 'monthly_data' in summary
-            assert 'totals' in summary
+        assert len(queries) <= 1
+        
+        assert 'monthly_data' in summary
+        assert 'totals' in summary
     
-    def test_distribucion_tramites(self, app, init_database):
-        """Test obtener distribución de trámites por tipo."""
-        with app.app_context():
-            from ARCHIVOS.database import tramite_repository
-            
-            # Crear trámites de diferentes tipos
-            tramite_repository.add_bulk(
-                papeleria_id=1,
-                tramite='TIPO A',
-                user_id=1,
-                fecha=date.today().strftime('%Y-%m-%d'),
-                precio=50.00,
-                costo=25.00,
-                cantidad=3
+    def test_analytics_dashboard_bundle(self, app, init_database):
+        """Test que el paquete de analytics coincida con los métodos individuales."""
+        from ARCHIVOS.database import tramite_repository, analytics_repository
+        
+        # Ambas altas en una sola transacción
+        with db.session.begin_nested():
+            tramite_repository.add_bulk(1, 'ANALYTICS 1', 1, date.today(),
+                                        100.00, 40.00, 2, commit=False)
+            tramite_repository.add_bulk(1, 'ANALYTICS 2', 1, date.today() - timedelta(days=40),
+                                        30.00, 10.00, 1, commit=False)
+        
+        bundle = analytics_repository.get_dashboard_bundle(1)
+        
+        assert bundle['meta_progress'] == analytics_repository.get_meta_mensual_progress(1)
+        assert bundle['mejor_mes'] == analytics_repository.get_mejor_mes_historico(1)
+        assert bundle['dia_productivo'] == analytics_repository.get_dias_mas_productivos(1)
+        assert bundle['margen_promedio'] == analytics_repository.get_margen_promedio(1)
+        assert bundle['costo_promedio_tramite'] == analytics_repository.get_costo_promedio_tramite(1)
+        assert bundle['roi_papelerias'] == analytics_repository.get_roi_por_papeleria(1)
+        assert bundle['rentabilidad_tramites'] == analytics_repository.get_rentabilidad_por_tramite(1)
+
+    def test_resumen_mensual_ignora_fechas_futuras(self, app, init_database, papeleria_id):
+        """Test que el resumen de los últimos 12 meses no cuente trámites con fecha posterior a hoy."""
+        from ARCHIVOS.database import tramite_repository
+        
+        hoy = date.today()
+        futuro = hoy + timedelta(days=1)
+        if futuro.month != hoy.month:
+            pytest.skip('hoy es el último día del mes: no hay fechas futuras dentro del mes en curso')
+        tramite_repository.add_bulk(papeleria_id, 'HOY', 1, hoy, 40.00, 10.00, 1)
+        tramite_repository.add_bulk(papeleria_id, 'FUTURO', 1, futuro, 100.00, 30.00, 1)
+        
+        totals = tramite_repository.get_monthly_summary(1)['totals']
+        assert totals['total_ingresos'] == 40.00
+        assert totals['total_gastos'] == 10.00
+        
+        totals = tramite_repository.get_monthly_summary_for_papeleria(papeleria_id, 1)['totals']
+        assert totals['total_ingresos'] == 40.00
+        assert totals['total_gastos'] == 10.00
+
+    def test_resumen_mensual_rango_invertido(self, app, init_database):
+        """Test que un rango con fecha_inicio posterior a fecha_fin devuelva series vacías."""
+        from ARCHIVOS.database import tramite_repository
+        
+        resumen = tramite_repository.get_monthly_summary(1, fecha_inicio='2025-06-01', fecha_fin='2025-03-01')
+        
+        assert resumen['monthly_data'] == []
+        assert resumen['totals'] == {'total_ingresos': 0, 'total_gastos': 0, 'total_ganancia': 0}
+
+    def test_resumen_mensual_sincronizado(self, app, init_database):
+        """Test que el resumen mensual siga a las altas, cambios y bajas de trámites."""
+        from ARCHIVOS.database import tramite_repository
+
+        def resumen():
+            return sorted(
+                (r.papeleria_id, r.month, r.ingresos, r.costos, r.count)
+                for r in db.session.execute(select(TramiteMonthlyRollup).where(TramiteMonthlyRollup.user_id == 1)).scalars()
             )
-            
-            tramite_repository.add_bulk(
-                papeleria_id=1,
-                tramite='TIPO B',
-                user_id=1,
-                fecha=date.today().strftime('%Y-%m-%d'),
-                precio=30.00,
-                costo=15.00,
-                cantidad=2
+
+        def desde_tramites():
+            return sorted(
+                tuple(fila) for fila in db.session.query(
+                    Tramite.papeleria_id, Tramite.mes, db.func.sum(Tramite.precio),
+                    db.func.sum(Tramite.costo), db.func.count(Tramite.id)
+                ).filter_by(user_id=1).group_by(Tramite.papeleria_id, Tramite.mes).all()
             )
-            
+
+        hoy = date.today()
+        tramite_repository.add_bulk(1, 'ROLLUP', 1, hoy, 50.00, 20.00, 2)
+        tramite_repository.add_bulk(1, 'ROLLUP', 1, hoy - timedelta(days=40), 10.00, 5.00, 1)
+        assert resumen() == desde_tramites()
+
+        tramite = db.session.execute(
+            select(Tramite).where(Tramite.tramite == 'ROLLUP', Tramite.user_id == 1).limit(1)
+        ).scalar_one()
+        tramite_repository.update(tramite.id, 1, hoy - timedelta(days=40), 'ROLLUP', 70.00, 30.00)
+        assert resumen() == desde_tramites()
+
+        tramite_repository.delete(tramite.id, 1)
+        assert resumen() == desde_tramites()
+
+    def test_distribucion_tramites(self, app, init_database, count_queries):
+        """Test obtener distribución de trámites por tipo."""
+        from ARCHIVOS.database import tramite_repository
+        
+        # Crear trámites de diferentes tipos en una sola transacción
+        hoy = date.today()
+        with db.session.begin_nested():
+            tramite_repository.add_bulk(1, 'TIPO A', 1, hoy, 50.00, 25.00, 3, commit=False)
+            tramite_repository.add_bulk(1, 'TIPO B', 1, hoy, 30.00, 15.00, 2, commit=False)
+        
+        with count_queries() as queries:
             dist = tramite_repository.get_tramites_distribution(1)
-            
-            assert len(dist) > 0
+        
+        assert len(dist) > 0
+        assert len(queries) <= 1
 
 
 class TestTramiteCostos:
     """Tests para costos predefinidos de trámites."""
     
-    def test_establecer_costo_tramite(self, app, init_database):
-        """Test establecer costo predefinido para un trámite."""
-        with app.app_context():
-            from ARCHIVOS.database import tramite_repository
-            
-            tramite_repository.set_costo('ACTA DE DEFUNCION', 35.00, 1)
-            
-            costo = tramite_repository.get_costo_for_tramite('ACTA DE DEFUNCION', 1)
-            assert costo == 35.00
+    @pytest.mark.parametrize('costos, esperado', [
+        ([35.00], 35.00),
+        ([20.00, 25.00], 25.00),
+    ], ids=['establecer', 'actualizar'])
+    def test_costo_tramite(self, app, init_database, count_queries, costos, esperado):
+        """Test establecer y actualizar el costo predefinido: la última llamada gana."""
+        from ARCHIVOS.database import tramite_repository
+        
+        for costo in costos:
+            with count_queries() as queries:
+                tramite_repository.set_costo('RFC', costo, 1)
+            # UPSERT: una sola sentencia exista o no el costo
+            assert len([q for q in queries if 'SAVEPOINT' not in q]) == 1
+        
+        assert tramite_repository.get_costo_for_tramite('RFC', 1) == esperado
+    
+    def test_actualizar_costos_viejos(self, app, init_database):
+        """Test aplicar costos por defecto a trámites registrados con costo cero."""
+        from ARCHIVOS.database import tramite_repository
+        
+        tramite_repository.add_bulk(
+            papeleria_id=1,
+            tramite='COSTO CERO',
+            user_id=1,
+            fecha=date.today(),
+            precio=40.00,
+            costo=0,
+            cantidad=2
+        )
+        tramite_repository.set_costo('COSTO CERO', 15.00, 1)
+        
+        actualizados = tramite_repository.update_old_costos(1)
+        
+        assert actualizados == 2
+        tramites = db.session.execute(
+            select(Tramite).where(Tramite.tramite == 'COSTO CERO', Tramite.user_id == 1)
+        ).scalars().all()
+        assert all(t.costo == 15.00 for t in tramites)
+
+
+class TestTramitePerf:
+    """Benchmarks de las rutas críticas de trámites (ver pytest.ini para medirlos)."""
+    
+    def test_bench_add_bulk(self, benchmark, init_database, papeleria_id):
+        """Benchmark de registrar 100 trámites de una vez."""
+        from ARCHIVOS.database import tramite_repository
+        
+        hoy = date.today()
+        benchmark(tramite_repository.add_bulk, papeleria_id, 'BENCH', 1, hoy, 1.0, 0.5, 100)
+    
+    def test_bench_resumen_mensual(self, benchmark, init_database, papeleria_id):
+        """Benchmark del resumen mensual con un año de trámites."""
+        from ARCHIVOS.database import tramite_repository
+        
+        for dias in range(0, 365, 7):
+            fecha = date.today() - timedelta(days=dias)
+            tramite_repository.add_bulk(papeleria_id, f'BENCH {dias % 5}', 1, fecha, 50.00, 20.00, 3, commit=False)
+        
+        summary = benchmark(tramite_repository.get_monthly_summary, 1)
+        assert summary['monthly_data']
     
-    def test_actualizar_costo_tramite(self, app, init_database):
-        """Test actualizar costo predefinido."""
-        with app.app_context():
-            from ARCHIVOS.database import tramite_repository
-            
-            tramite_repository.set_costo('RFC', 20.00, 1)
-            tramite_repository.set_costo('RFC', 25.00, 1)
-            
-            costo = tramite_repository.get_costo_for_tramite('RFC', 1)
-            assert costo == 25.00
+    def test_bench_distribucion_tramites(self, benchmark, init_database, papeleria_id):
+        """Benchmark de la distribución de trámites por tipo."""
+        from ARCHIVOS.database import tramite_repository
+        
+        hoy = date.today()
+        for i in range(20):
+            tramite_repository.add_bulk(papeleria_id, f'BENCH {i}', 1, hoy, 30.00, 10.00, i + 1, commit=False)
+        
+        dist = benchmark(tramite_repository.get_tramites_distribution, 1)
+        assert len(dist) == 10
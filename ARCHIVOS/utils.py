@@ -1,8 +1,12 @@
-from flask import flash, redirect, url_for, session, current_app
+from flask import flash, redirect, url_for, session, current_app, request
 from functools import wraps
 from flask_login import current_user
 from .models import Papeleria, db
+import hashlib
 import os
+import time
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from werkzeug.utils import secure_filename
 
@@ -19,6 +23,127 @@ def get_effective_user_id():
         return current_user.get_id()
     return None
 
+# --- Caché de datos por usuario ---
+# Las claves combinan una versión global, la versión del usuario y la fecha del día: las vistas
+# dependen de date.today() (rango por defecto, metas del mes), así que cambian solas al cambiar el día.
+_GLOBAL_VERSION_KEY = "datos_version:global"
+
+def _data_version_key(user_id):
+    return f"datos_version:{user_id}"
+
+def bump_data_version(user_id):
+    """Invalida todas las respuestas cacheadas del usuario cambiando su versión de datos."""
+    current_app.cache.set(_data_version_key(user_id), time.time_ns(), timeout=0)
+
+def bump_all_data_versions():
+    """
+    Invalida las respuestas cacheadas de todos los usuarios (p. ej. tras restaurar un backup).
+    Cualquier escritura que no pase por una petición del propio usuario (scripts o comandos
+    que modifican la base directamente) debe llamar a esta función o a bump_data_version.
+    """
+    current_app.cache.set(_GLOBAL_VERSION_KEY, time.time_ns(), timeout=0)
+
+def _cache_scope(global_version, version):
+    return f"{global_version or 0}:{version or 0}:{date.today().isoformat()}"
+
+def cached_user_value(nombre, builder, *params, timeout=60):
+    """
+    Devuelve builder() cacheado por usuario efectivo, versión de datos y parámetros.
+    Cualquier escritura del usuario invalida el valor (ver bump_data_version).
+    """
+    cache = getattr(current_app, 'cache', None)
+    user_id = get_effective_user_id()
+    if cache is None or user_id is None:
+        return builder()
+
+    global_version, version = cache.get_many(_GLOBAL_VERSION_KEY, _data_version_key(user_id))
+    key = f"valor:{nombre}:{user_id}:{_cache_scope(global_version, version)}:" + ':'.join(map(str, params))
+    value = cache.get(key)
+    if value is None:
+        value = builder()
+        cache.set(key, value, timeout=timeout)
+    return value
+
+def cached_user_view(timeout=60):
+    """
+    Cachea la respuesta de una vista por usuario efectivo, versión de datos, fecha del día y
+    URL completa (incluye los filtros de la query string). Solo se guardan respuestas 200.
+
+    La misma clave se envía como ETag: si el navegador ya tiene esa versión (If-None-Match)
+    se responde 304 sin ejecutar la vista ni leer la caché.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            cache = getattr(current_app, 'cache', None)
+            user_id = get_effective_user_id()
+            if cache is None or user_id is None:
+                return f(*args, **kwargs)
+
+            global_version, version = cache.get_many(_GLOBAL_VERSION_KEY, _data_version_key(user_id))
+            if version is None:
+                # Sin versión registrada todavía: se fija una para poder emitir ETag
+                bump_data_version(user_id)
+                version = cache.get(_data_version_key(user_id))
+
+            key = f"vista:{f.__name__}:{user_id}:{_cache_scope(global_version, version)}:{request.full_path}"
+            # Con una caché que no guarda nada (NullCache) no hay versión fiable: sin ETag
+            etag = hashlib.md5(key.encode()).hexdigest() if version is not None else None
+            if etag and _etag_matches(etag):
+                return _with_etag(current_app.response_class(status=304), etag)
+
+            cached = cache.get(key)
+            if cached is not None:
+                body, mimetype = cached
+                return _with_etag(current_app.response_class(body, mimetype=mimetype), etag)
+
+            response = current_app.make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                cache.set(key, (response.get_data(), response.mimetype), timeout=timeout)
+                _with_etag(response, etag)
+            return response
+        return decorated_function
+    return decorator
+
+def _etag_matches(etag):
+    """
+    Compara con If-None-Match. Flask-Compress añade el algoritmo al ETag de las respuestas
+    comprimidas ("abc:br", "abc:gzip"), así que esas variantes también cuentan como coincidencia.
+    """
+    enviados = request.if_none_match
+    return etag in enviados or any(
+        tag.split(':', 1)[0] == etag for tag in enviados.as_set(include_weak=True)
+    )
+
+def _with_etag(response, etag):
+    """Añade el ETag y obliga al navegador a revalidar (respuesta privada del usuario)."""
+    if etag:
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+    return response
+
+# --- Consultas concurrentes ---
+# Pool compartido para lanzar en paralelo consultas de solo lectura independientes.
+_query_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='consultas')
+
+def run_concurrently(*calls):
+    """
+    Ejecuta llamadas independientes a los repositorios en paralelo y devuelve sus resultados en orden.
+    Cada llamada corre en su propio contexto de aplicación, es decir, con su propia sesión y conexión.
+    Una base SQLite en memoria comparte una única conexión, así que ahí se ejecutan en serie.
+    """
+    if db.engine.url.database in (None, '', ':memory:'):
+        return [call() for call in calls]
+
+    app = current_app._get_current_object()
+
+    def ejecutar(call):
+        with app.app_context():
+            return call()
+
+    return list(_query_executor.map(ejecutar, calls))
+
 # --- Decoradores ---
 def admin_required(f):
     @wraps(f)
@@ -79,7 +79,7 @@ Type=simple
 User=www-data
 Group=www-data
 WorkingDirectory=$TARGET_DIR
-ExecStart=/bin/bash -lc 'cd "$TARGET_DIR" && exec "$TARGET_DIR/.venv/bin/gunicorn" --workers 3 --bind unix:/run/gunicorn-docuexpress.sock wsgi:application'
+ExecStart=/bin/bash -lc 'cd "$TARGET_DIR" && exec "$TARGET_DIR/.venv/bin/gunicorn" --workers 3 --worker-class gthread --threads 4 --bind unix:/run/gunicorn-docuexpress.sock wsgi:application'
 Restart=on-failure
 RuntimeDirectory=gunicorn-docuexpress
 
@@ -36,7 +36,7 @@ start() {
   fi
 
   echo "Starting Gunicorn (binding to $BIND_ADDR), logs -> $LOGFILE"
-  nohup "$GUNICORN_BIN" -w 3 -b "$BIND_ADDR" wsgi:application --log-file "$LOGFILE" --access-logfile - > "$LOGFILE" 2>&1 &
+  nohup "$GUNICORN_BIN" -w 3 -k gthread --threads 4 -b "$BIND_ADDR" wsgi:application --log-file "$LOGFILE" --access-logfile - > "$LOGFILE" 2>&1 &
   echo $! > "$PIDFILE"
   sleep 2
 